@@ -0,0 +1,463 @@
+import os
+import sys
+import re
+import json
+import time
+import types
+import random
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ================== BOT IMPORT (LOCAL) ==================
+def import_bot(workdir, api_url="http://127.0.0.1:9/bot{0}/{1}", env=None):
+    # server.py import paytida ishga tushadi -> hamma narsani vaqtinchalik papkaga yo'naltiramiz
+    os.environ.setdefault("TOKEN", "123456:BENCH")
+    os.environ["BOT_LOCK_FILE"] = os.path.join(workdir, "bot.lock")
+    os.environ["DB_PATH"] = os.path.join(workdir, "bot.db")
+    os.environ["PORT"] = "0"
+    for k, v in (env or {}).items():
+        os.environ[k] = str(v)
+
+    sys.path.insert(0, BASE_DIR)
+    os.chdir(workdir)
+
+    from telebot import apihelper
+    apihelper.API_URL = api_url
+    import server
+    return server
+
+# ================== RANGE SERVER ==================
+def start_range_server(data, conn_kbps, latency_ms):
+    # har bir ulanish alohida cheklangan (CDN'lardagi per-connection throttle kabi)
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            return
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            total = len(data)
+            start, end = 0, total - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or total - 1), total - 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+
+            rate = conn_kbps * 1024
+            pos = start
+            try:
+                while pos <= end:
+                    block = data[pos:min(pos + 64 * 1024, end + 1)]
+                    self.wfile.write(block)
+                    pos += len(block)
+                    time.sleep(len(block) / rate)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def bench_ranged(args):
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    server = import_bot(workdir)
+
+    data = os.urandom(int(args.size_mb * 1024 * 1024))
+    digest = hashlib.sha256(data).hexdigest()
+    srv = start_range_server(data, args.conn_kbps, args.latency_ms)
+    url = f"http://127.0.0.1:{srv.server_port}/media.bin"
+
+    print(f"📦 {args.size_mb} MB | 1 ulanish = {args.conn_kbps} KB/s | latency {args.latency_ms} ms")
+    for name, fn in (("serial", server.serial_download), ("ranged", server.ranged_download)):
+        dst = os.path.join(workdir, f"{name}.bin")
+        start = time.time()
+        fn(url, dst, proxy="")
+        elapsed = time.time() - start
+        with open(dst, "rb") as f:
+            ok = hashlib.sha256(f.read()).hexdigest() == digest
+        mb_s = args.size_mb / elapsed
+        print(f"{name:>7}: {elapsed:6.2f}s  {mb_s:6.2f} MB/s  {'✅' if ok else '❌ hash mos emas'}")
+
+    srv.shutdown()
+
+# ================== FAKE BOT API ==================
+# Telegram Bot API o'rnida: javoblar minimal, lekin telebot parse qila oladigan
+FINAL_ERROR_PREFIXES = ("❌", "⛔")
+
+class FakeBotApi:
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.waiters = {}   # chat_id -> (predicate, event, result)
+        self.calls = {}     # method -> soni
+        self.upload_bytes = 0
+        self.message_id = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                return
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                params = {k: v[0] for k, v in query.items()}
+                time.sleep(api.latency_ms / 1000)
+
+                body = json.dumps({"ok": True, "result": api.result(method, params, length)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.srv.daemon_threads = True
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.srv.server_port}/bot{{0}}/{{1}}"
+
+    def expect(self, chat_id, predicate):
+        event = threading.Event()
+        result = {}
+        with self.lock:
+            self.waiters[chat_id] = (predicate, event, result)
+        return event, result
+
+    def message(self, chat_id, **extra):
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def result(self, method, params, length):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method in ("sendAudio", "sendVideo") and length:
+                self.upload_bytes += length
+
+        chat_id = int(params["chat_id"]) if params.get("chat_id", "").lstrip("-").isdigit() else 0
+        text = params.get("text", "")
+        self.notify(chat_id, method, params, text)
+
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "Bench"}}
+        if method == "getChat":
+            return {"id": -1, "type": "channel", "title": "bench"}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getMyDescription":
+            return {"description": ""}
+        if method == "sendAudio":
+            # file_id berilgan bo'lsa o'sha qaytadi, aks holda yangi
+            file_id = params.get("audio") or f"AUDIO{hashlib.md5(os.urandom(8)).hexdigest()}"
+            return self.message(chat_id, audio={"file_id": file_id, "file_unique_id": file_id[-16:], "duration": 1})
+        if method == "sendVideo":
+            file_id = params.get("video") or f"VIDEO{hashlib.md5(os.urandom(8)).hexdigest()}"
+            return self.message(chat_id, video={"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1, "height": 1, "duration": 1})
+        if method in ("sendMessage", "editMessageText"):
+            return self.message(chat_id, text=text)
+        return True
+
+    def notify(self, chat_id, method, params, text):
+        with self.lock:
+            waiter = self.waiters.get(chat_id)
+        if not waiter:
+            return
+        predicate, event, result = waiter
+        if method == "sendMessage" and text.startswith(FINAL_ERROR_PREFIXES):
+            result["error"] = text
+        elif not predicate(method, params):
+            return
+        with self.lock:
+            self.waiters.pop(chat_id, None)
+        event.set()
+
+# ================== FAKE YT-DLP ==================
+def fake_video_id(seed):
+    return hashlib.sha1(seed.encode()).hexdigest()[:11]
+
+def synthetic_media(workdir, ext, seconds, size_kb):
+    # ffmpeg bo'lsa haqiqiy fayl (mp3/IG audio ajratish ham ishlaydi), bo'lmasa tasodifiy baytlar
+    path = os.path.join(workdir, f"synthetic.{ext}")
+    if shutil.which("ffmpeg"):
+        args = ["-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}"]
+        if ext == "mp4":
+            args = ["-f", "lavfi", "-i", f"testsrc=size=320x240:rate=10:duration={seconds}"] + args + ["-c:v", "libx264"]
+        subprocess.run(["ffmpeg", "-loglevel", "error", "-y", *args, "-c:a", "aac", "-shortest", path], check=True)
+    else:
+        with open(path, "wb") as f:
+            f.write(os.urandom(size_kb * 1024))
+    return path
+
+def install_fake_ytdlp(args, media, media_urls):
+    # server.py `import yt_dlp` qilganda shu modul olinadi
+    # ✅ media lokal range serverdan http orqali: pool, ranged va stream yo'llari haqiqiy ishlaydi
+    class FakeYoutubeDL:
+        def __init__(self, params=None):
+            self.params = dict(params or {})
+            outtmpl = self.params.get("outtmpl") or "%(id)s.%(ext)s"
+            self.params["outtmpl"] = dict(outtmpl) if isinstance(outtmpl, dict) else {"default": outtmpl}
+
+        def extract_info(self, target, download=False):
+            match = re.match(r"ytsearch(\d*):(.*)", target)
+            if match:
+                time.sleep(args.search_ms / 1000)
+                query = match.group(2)
+                return {"_type": "playlist", "entries": [
+                    {"id": fake_video_id(f"{query}:{i}"), "title": f"{query} - track {i + 1}", "duration": args.duration}
+                    for i in range(int(match.group(1) or 1))
+                ]}
+
+            time.sleep(args.meta_ms / 1000)
+            instagram = "instagram.com" in target
+            video_id = target.rstrip("/").rsplit("/", 1)[-1][-11:]
+            info = {
+                "id": video_id, "title": f"bench {video_id}", "duration": args.duration,
+                "ext": "mp4" if instagram else "m4a", "acodec": "mp4a.40.2",
+                "protocol": "http", "url": media_urls["mp4" if instagram else "m4a"],
+                "filesize": os.path.getsize(media["mp4" if instagram else "m4a"]),
+            }
+            return self.process_ie_result(info, download=True) if download else info
+
+        def process_ie_result(self, info, download=True):
+            time.sleep(args.download_ms / 1000)
+            path = self.prepare_filename(info)
+            with urllib.request.urlopen(info["url"], timeout=60) as resp, open(path, "wb") as f:
+                shutil.copyfileobj(resp, f)
+            return {**info, "requested_downloads": [{"filepath": path}]}
+
+        def prepare_filename(self, info):
+            return self.params["outtmpl"]["default"] % info
+
+        def sanitize_info(self, info):
+            return info
+
+    module = types.ModuleType("yt_dlp")
+    module.YoutubeDL = FakeYoutubeDL
+    sys.modules["yt_dlp"] = module
+
+# ================== LOAD ==================
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"search", "hit", "callback", "instagram"}
+    if unknown:
+        raise SystemExit(f"Noma'lum traffic turi: {', '.join(sorted(unknown))}")
+    return mix
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+def build_ops(args, rng):
+    mix = parse_mix(args.mix)
+    artists = [f"artist {i}" for i in range(args.artists)]
+    hits = [fake_video_id(f"hit:{i}") for i in range(args.hits)]
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+
+    ops = []
+    for kind in kinds:
+        if kind == "search":
+            payload = rng.choice(artists)
+        elif kind == "hit":
+            payload = f"https://youtu.be/{rng.choice(hits)}"
+        elif kind == "callback":
+            # foydalanuvchi top 10 dan birini bosadi
+            payload = f"song_{fake_video_id(f'{rng.choice(artists)}:{rng.randrange(10)}')}"
+        else:
+            payload = f"https://www.instagram.com/reel/{fake_video_id(f'reel:{rng.randrange(args.reels)}')}/"
+        ops.append((kind, payload, 1000 + rng.randrange(args.users)))
+    return ops
+
+def run_load_level(args):
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    media = {
+        "m4a": synthetic_media(workdir, "m4a", min(args.duration, 10), args.audio_kb),
+        "mp4": synthetic_media(workdir, "mp4", min(args.duration, 10), args.audio_kb * 4),
+    }
+    has_ffmpeg = bool(shutil.which("ffmpeg"))
+
+    api = FakeBotApi(args.api_ms)
+    media_urls = {}
+    for ext, path in media.items():
+        with open(path, "rb") as f:
+            srv = start_range_server(f.read(), args.conn_kbps, args.latency_ms)
+        media_urls[ext] = f"http://127.0.0.1:{srv.server_port}/media.{ext}"
+    # workerlar server.py import paytida fork qilinadi -> fake yt_dlp undan oldin o'rnatiladi
+    install_fake_ytdlp(args, media, media_urls)
+    # per-user limit pipeline o'lchoviga xalaqit bermasin (kerak bo'lsa --env bilan yoqiladi)
+    # IG video (audio_kb * 4) ranged yo'ldan, audio esa yt-dlp pool orqali yuklanadi
+    env = {
+        "AUDIO_DELIVERY_MODE": args.mode, "YTDLP_PROCESSES": args.ytdlp_processes, "USER_RATE": 1000, "USER_BURST": 1000,
+        "RANGED_MIN_MB": args.audio_kb * 2 / 1024,
+    }
+    env.update(kv.split("=", 1) for kv in args.env)
+    server = import_bot(workdir, api.url, env)
+    from telebot import types as tg
+
+    def is_done(kind):
+        if kind == "search":
+            # top 10 klaviatura yoki (natija bo'lmasa) audio
+            return lambda method, params: method == "sendAudio" or (method == "sendMessage" and "reply_markup" in params)
+        if kind == "instagram" and not has_ffmpeg:
+            # ffmpeg yo'q -> faqat video yuboriladi
+            return lambda method, params: method == "sendVideo"
+        return lambda method, params: method == "sendAudio"
+
+    def run_op(seq, kind, payload, user_id):
+        chat_id = 10_000_000 + seq
+        user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+        message = {"message_id": seq, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": user, "text": payload}
+        if kind == "callback":
+            update = {"update_id": seq, "callback_query": {"id": str(seq), "from": user, "chat_instance": "bench", "data": payload, "message": message}}
+        else:
+            update = {"update_id": seq, "message": message}
+        update = tg.Update.de_json(update)
+
+        event, result = api.expect(chat_id, is_done(kind))
+        start = time.monotonic()
+        try:
+            if kind == "callback":
+                server.song_callback(update.callback_query)
+            else:
+                server.handle(update.message)
+            ok = event.wait(args.timeout)
+        except Exception as e:
+            result["error"] = str(e)
+            ok = True
+        elapsed = time.monotonic() - start
+        status = "timeout" if not ok else ("error" if "error" in result else "ok")
+        return kind, status, elapsed
+
+    ops = build_ops(args, random.Random(args.seed))
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda x: run_op(x[0], *x[1]), enumerate(ops)))
+    wall = time.monotonic() - started
+    # ✅ yt-dlp workerlari yopiladi: CPU'si RUSAGE_CHILDREN'ga qo'shiladi, stdout pipe ham bo'shaydi
+    for pool in server.ytdl_pools.values():
+        pool.shutdown(wait=True, cancel_futures=True)
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime for a, b in zip(cpu_after, cpu_before))
+
+    report = {
+        "concurrency": args.concurrency, "requests": len(results), "wall": wall,
+        "throughput": len(results) / wall if wall else 0, "cpu": cpu,
+        # Linux'da ru_maxrss KB
+        "peak_rss_mb": max(r.ru_maxrss for r in cpu_after) / 1024,
+        "upload_mb": api.upload_bytes / 1024 / 1024,
+        # qaysi yuklash yo'llari ishlagani (ranged / yt-dlp pool orqali serial)
+        "downloads": {k: server.DOWNLOAD_STATS[k] for k in ("ranged", "serial")},
+        "kinds": {},
+    }
+    for kind in sorted({k for k, _, _ in results}) + ["all"]:
+        rows = [r for r in results if kind in ("all", r[0])]
+        latencies = [e for _, status, e in rows if status == "ok"]
+        report["kinds"][kind] = {
+            "n": len(rows),
+            "ok": len(latencies),
+            "error": sum(1 for r in rows if r[1] == "error"),
+            "timeout": sum(1 for r in rows if r[1] == "timeout"),
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99),
+        }
+    print("RESULT " + json.dumps(report))
+    sys.stdout.flush()
+    # bot threadlari daemon emas bo'lishi mumkin -> darhol chiqamiz
+    os._exit(0)
+
+def bench_load(args):
+    if args.one:
+        run_load_level(args)
+        return
+
+    # ✅ har bir concurrency darajasi alohida processda: keshlar sovuq, o'lchovlar taqqoslanadigan
+    print(f"🧪 mix={args.mix} | {args.requests} so'rov | mode={args.mode} | ffmpeg={'bor' if shutil.which('ffmpeg') else 'yoq'}")
+    for level in [int(x) for x in args.concurrency_levels.split(",")]:
+        cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--one", "--concurrency", str(level)]
+        out = subprocess.run(cmd, capture_output=True, text=True)
+        line = next((l for l in out.stdout.splitlines() if l.startswith("RESULT ")), None)
+        if not line:
+            print(f"❌ concurrency={level} ishlamadi:\n{out.stdout[-2000:]}{out.stderr[-2000:]}")
+            continue
+        r = json.loads(line[len("RESULT "):])
+        print(f"\n⚙️ concurrency={level}: {r['throughput']:.1f} so'rov/s | wall {r['wall']:.1f}s | "
+              f"CPU {r['cpu']:.1f}s | peak RSS {r['peak_rss_mb']:.0f} MB | upload {r['upload_mb']:.1f} MB | "
+              f"yuklash: {r['downloads']['ranged']} ranged, {r['downloads']['serial']} pool")
+        print(f"{'tur':>10} {'n':>5} {'ok':>5} {'err':>4} {'t/o':>4} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for kind, k in r["kinds"].items():
+            print(f"{kind:>10} {k['n']:>5} {k['ok']:>5} {k['error']:>4} {k['timeout']:>4} "
+                  f"{k['p50'] * 1000:7.0f}ms {k['p95'] * 1000:7.0f}ms {k['p99'] * 1000:7.0f}ms")
+
+# ================== MAIN ==================
+def main():
+    parser = argparse.ArgumentParser(description="Musiqa bot benchmarklari (lokal, tarmoqsiz)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    ranged = sub.add_parser("ranged", help="serial vs parallel Range yuklash")
+    ranged.add_argument("--size-mb", type=float, default=32)
+    ranged.add_argument("--conn-kbps", type=int, default=2048)
+    ranged.add_argument("--latency-ms", type=int, default=20)
+    ranged.set_defaults(fn=bench_ranged)
+
+    load = sub.add_parser("load", help="handle/song_callback yuklama testi (soxta Bot API + soxta yt-dlp)")
+    load.add_argument("--mix", default="search=40,hit=30,callback=20,instagram=10")
+    load.add_argument("--concurrency-levels", default="1,4,16")
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--artists", type=int, default=30)
+    load.add_argument("--hits", type=int, default=5, help="takror so'raladigan hit qo'shiqlar soni")
+    load.add_argument("--reels", type=int, default=20, help="Instagram reel'lar soni (takrorlar keshdan)")
+    load.add_argument("--search-ms", type=int, default=300)
+    load.add_argument("--meta-ms", type=int, default=200)
+    load.add_argument("--download-ms", type=int, default=500)
+    load.add_argument("--api-ms", type=int, default=30)
+    load.add_argument("--audio-kb", type=int, default=512)
+    load.add_argument("--duration", type=int, default=200)
+    load.add_argument("--mode", default="native", choices=("native", "mp3"))
+    load.add_argument("--ytdlp-processes", type=int, default=2)
+    load.add_argument("--conn-kbps", type=int, default=8192, help="media serverda 1 ulanish tezligi")
+    load.add_argument("--latency-ms", type=int, default=5)
+    load.add_argument("--timeout", type=float, default=300)
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--env", action="append", default=[], help="server.py uchun qo'shimcha KEY=VALUE")
+    load.add_argument("--one", action="store_true", help=argparse.SUPPRESS)
+    load.add_argument("--concurrency", type=int, default=1, help=argparse.SUPPRESS)
+    load.set_defaults(fn=bench_load)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,63 @@
+import time
+# ✅ startup bosqichlari shu nuqtadan o'lchanadi (importlar ham)
+STARTUP_T0 = time.monotonic()
 import telebot
-from telebot import types
-import yt_dlp
+from telebot import types, util
 import os
 import subprocess
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import glob
 import threading
-import time
+import queue
+import atexit
+import math
+import hashlib
+import hmac
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
 import warnings
 import base64
 import traceback
 import shutil
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import requests
+import requests.adapters
+import tempfile
+import re
+import urllib.parse
+import json
+from collections import deque, OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
 from telebot import apihelper
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+import ytdl_worker
+from ytdl_worker import YtdlpError
 
-PROXY_ENV_KEYS = [
-    "HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY",
-    "http_proxy", "https_proxy", "all_proxy",
-]
+# ================== STARTUP TIMING ==================
+STARTUP_PHASES = []
+_startup_last = STARTUP_T0
 
-@contextmanager
-def temp_unset_env(keys):
-    saved = {}
-    for k in keys:
-        if k in os.environ:
-            saved[k] = os.environ[k]
-            os.environ.pop(k, None)
-    try:
-        yield
-    finally:
-        for k, v in saved.items():
-            os.environ[k] = v
+def startup_mark(name):
+    global _startup_last
+    now = time.monotonic()
+    STARTUP_PHASES.append((name, now - _startup_last))
+    _startup_last = now
+
+def startup_report():
+    parts = " | ".join(f"{name} {sec * 1000:.0f}ms" for name, sec in STARTUP_PHASES)
+    print(f"⏱ Startup: {parts} | jami {(time.monotonic() - STARTUP_T0) * 1000:.0f}ms")
 
+startup_mark("importlar")
 
 load_dotenv()
 
 # ================== SINGLE INSTANCE LOCK (409 fix) ==================
-LOCK_FILE = "/tmp/telegram_bot.lock"
+# Webhook rejimida bir nechta replika bo'lishi mumkin -> lock faqat polling uchun
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+LOCK_FILE = os.getenv("BOT_LOCK_FILE", "/tmp/telegram_bot.lock")
 
 def acquire_lock():
     try:
@@ -51,7 +69,8 @@ def acquire_lock():
         print("⛔ Bot already running (lock exists). Exiting...")
         raise SystemExit(0)
 
-acquire_lock()
+if not WEBHOOK_URL:
+    acquire_lock()
 
 # ================== PATHS ==================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -61,6 +80,20 @@ COOKIES_PATH = os.path.join(BASE_DIR, "cookies.txt")
 IG_COOKIES_PATH = os.path.join(BASE_DIR, "ig_cookies.txt")
 
 # ================== COOKIES RESTORE ==================
+def write_if_changed(path, data):
+    # ✅ restartda fayl bir xil bo'lsa qayta yozmaymiz; yozish atomik (workerlar bir vaqtda o'qishi mumkin)
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
 def ensure_cookies_file():
     b64 = os.getenv("YTDLP_COOKIES_B64", "").strip()
     print("COOKIES ENV bor-mi:", bool(b64))
@@ -71,14 +104,10 @@ def ensure_cookies_file():
 
     try:
         data = base64.b64decode(b64)
-        with open(COOKIES_PATH, "wb") as f:
-            f.write(data)
-
-        size = os.path.getsize(COOKIES_PATH)
-        print("✅ cookies.txt tiklandi. size =", size, "bytes")
+        if write_if_changed(COOKIES_PATH, data):
+            print("✅ cookies.txt tiklandi. size =", len(data), "bytes")
 
-        with open(COOKIES_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            first = f.readline()
+        first = data.split(b"\n", 1)[0].decode("utf-8", errors="ignore")
         if "Netscape" not in first:
             print("⚠️ cookies.txt Netscape format emasga o‘xshaydi (cookies exportni qayta qil)")
 
@@ -98,14 +127,10 @@ def ensure_ig_cookies_file():
 
     try:
         data = base64.b64decode(b64)
-        with open(IG_COOKIES_PATH, "wb") as f:
-            f.write(data)
+        if write_if_changed(IG_COOKIES_PATH, data):
+            print("✅ ig_cookies.txt tiklandi. size =", len(data), "bytes")
 
-        size = os.path.getsize(IG_COOKIES_PATH)
-        print("✅ ig_cookies.txt tiklandi. size =", size, "bytes")
-
-        with open(IG_COOKIES_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            first = f.readline()
+        first = data.split(b"\n", 1)[0].decode("utf-8", errors="ignore")
         if "Netscape" not in first:
             print("⚠️ ig_cookies.txt Netscape format emasga o‘xshaydi (IG cookies exportni qayta qil)")
 
@@ -126,7 +151,6 @@ CHANNELS = ["@efoouz"]
 ADMINS = [5664207838]
 warnings.filterwarnings("ignore")
 
-user_search_cache = {}
 DOWNLOAD_DIR = "downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
@@ -134,14 +158,133 @@ apihelper.READ_TIMEOUT = 300
 apihelper.WRITE_TIMEOUT = 300
 apihelper.CONNECT_TIMEOUT = 300
 
+# ================== YT-DLP WORKERS (FORK) ==================
+# ✅ startup'da barcha lane'larning worker processlari hali birorta thread yo'q paytda fork qilinadi
+# (TeleBot'ning thread pool'i, pool'larning manager/feeder threadlari, db-writer, http — hammasi keyin)
+YTDLP_PROCESSES = int(os.getenv("YTDLP_PROCESSES", "2"))
+# search/meta alohida pool'da: uzun yuklashlar qidiruvni navbatda ushlab turmaydi
+YTDLP_SEARCH_PROCESSES = int(os.getenv("YTDLP_SEARCH_PROCESSES", "1"))
+YTDLP_LANES = {"search": "fast", "meta": "fast", "audio": "download", "instagram": "download"}
+YTDLP_LANE_WORKERS = {"fast": max(1, YTDLP_SEARCH_PROCESSES), "download": YTDLP_PROCESSES}
+
+def make_ytdl_pool(workers):
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=ytdl_worker.init,
+    )
+    # submit() manager threadni ishga tushiradi -> workerlar undan oldin, shu yerda ochiladi
+    # (fork kontekstida submit ham aynan shu metodni chaqiradi; keyin qayta fork qilmaydi)
+    pool._launch_processes()
+    return pool
+
+ytdl_pools = {}
+if YTDLP_PROCESSES > 0:
+    # avval hamma pool'lar ochiladi, hech biriga submit qilinmaydi
+    for lane, workers in YTDLP_LANE_WORKERS.items():
+        ytdl_pools[lane] = make_ytdl_pool(workers)
+
+def kill_ytdl_workers():
+    # os._exit'dan oldin: workerlar parent o'lganini sezmaydi va yetim bo'lib qoladi
+    for pool in list(ytdl_pools.values()):
+        for proc in list((pool._processes or {}).values()):
+            proc.kill()
+
 bot = telebot.TeleBot(TOKEN, threaded=True)
 
+startup_mark("sozlamalar")
+
 # ================== DATABASE ==================
+# WAL + uzoq yashovchi ulanishlar; barcha yozuvlar bitta writer threadda, batch bilan
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "500"))
+
+def db_connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+_db_local = threading.local()
+
 def get_db():
-    conn = sqlite3.connect("bot.db", check_same_thread=False)
+    # har bir thread o'z o'qish ulanishini qayta ishlatadi
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = db_connect()
     return conn, conn.cursor()
 
-conn, c = get_db()
+def db_fetchone(sql, params=()):
+    _, c = get_db()
+    c.execute(sql, params)
+    return c.fetchone()
+
+def db_fetchall(sql, params=()):
+    _, c = get_db()
+    c.execute(sql, params)
+    return c.fetchall()
+
+class DBWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.conn = db_connect()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="db-writer")
+        self.thread.start()
+
+    def write(self, sql, params=()):
+        self.queue.put((sql, params))
+
+    def flush(self, timeout=10):
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + DB_FLUSH_INTERVAL
+            while len(batch) < DB_BATCH_MAX and not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        waiters = [item for item in batch if isinstance(item, threading.Event)]
+        writes = [item for item in batch if not isinstance(item, threading.Event)]
+        try:
+            if writes:
+                self.conn.execute("BEGIN")
+                for sql, params in writes:
+                    try:
+                        self.conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        print("❌ DB yozish xato:", e, sql.split("(")[0].strip())
+                self.conn.execute("COMMIT")
+        except Exception as e:
+            print("❌ DB commit xato:", e)
+            try:
+                self.conn.execute("ROLLBACK")
+            except Exception:
+                pass
+        finally:
+            for done in waiters:
+                done.set()
+
+db_writer = DBWriter()
+
+def db_write(sql, params=()):
+    db_writer.write(sql, params)
+
+def db_flush(timeout=10):
+    return db_writer.flush(timeout)
+
+atexit.register(db_flush)
+
+conn = db_connect()
+c = conn.cursor()
 c.execute("""
 CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY,
@@ -167,69 +310,430 @@ CREATE TABLE IF NOT EXISTS bot_stats (
     requests_today INTEGER DEFAULT 0
 )
 """)
-conn.commit()
+c.execute("""
+CREATE TABLE IF NOT EXISTS stats_hll (
+    date TEXT PRIMARY KEY,
+    registers BLOB
+)
+""")
+c.execute("""
+CREATE TABLE IF NOT EXISTS file_cache (
+    cache_key TEXT PRIMARY KEY,
+    file_id TEXT,
+    kind TEXT,
+    title TEXT,
+    hits INTEGER DEFAULT 0,
+    created_at TEXT,
+    last_used TEXT
+)
+""")
+c.execute("""
+CREATE TABLE IF NOT EXISTS search_cache (
+    query TEXT PRIMARY KEY,
+    results TEXT,
+    created_at REAL
+)
+""")
+c.execute("""
+CREATE TABLE IF NOT EXISTS audio_cache (
+    cache_key TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    created_at REAL,
+    last_access REAL
+)
+""")
+c.execute("""
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_chat_id INTEGER,
+    from_chat_id INTEGER,
+    message_id INTEGER,
+    text TEXT,
+    status TEXT,
+    last_user_id INTEGER DEFAULT 0,
+    total INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    blocked INTEGER DEFAULT 0,
+    created_at REAL,
+    updated_at REAL
+)
+""")
+# ✅ eski bazalarda users.blocked ustuni yo'q
+if "blocked" not in [row[1] for row in c.execute("PRAGMA table_info(users)")]:
+    c.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+# ✅ broadcast egasi (replika) va lease muddati
+broadcast_cols = [row[1] for row in c.execute("PRAGMA table_info(broadcasts)")]
+if "owner" not in broadcast_cols:
+    c.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+if "lease_until" not in broadcast_cols:
+    c.execute("ALTER TABLE broadcasts ADD COLUMN lease_until REAL DEFAULT 0")
+c.execute("CREATE INDEX IF NOT EXISTS idx_music_requests_created_at ON music_requests(created_at)")
+c.execute("CREATE INDEX IF NOT EXISTS idx_music_requests_user_id ON music_requests(user_id)")
+c.execute("CREATE INDEX IF NOT EXISTS idx_audio_cache_last_access ON audio_cache(last_access)")
+c.execute("""
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    video_id TEXT UNIQUE,
+    title TEXT,
+    queries TEXT DEFAULT '',
+    duration INTEGER,
+    plays INTEGER DEFAULT 0,
+    last_played REAL
+)
+""")
+c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_plays ON tracks(plays)")
+# ✅ FTS5 ba'zi SQLite build'larda yo'q -> lokal qidiruv LIKE bilan ishlaydi
+try:
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(title, queries, tokenize='unicode61 remove_diacritics 2')")
+    FTS_ENABLED = True
+except sqlite3.OperationalError as e:
+    FTS_ENABLED = False
+    print("⚠️ FTS5 yo'q, lokal qidiruv LIKE bilan:", e)
 conn.close()
 
+startup_mark("db")
+
 # ================== UTIL ==================
 def is_admin(user_id):
     return user_id in ADMINS
 
-def clear_downloads():
+stats_lock = threading.Lock()
+
+def stat_inc(stats, key, n=1):
+    with stats_lock:
+        stats[key] = stats.get(key, 0) + n
+
+# ================== METRICS ==================
+# Prometheus uchun minimal histogram: bosqich -> bucket hisoblagichlari
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ERROR_STATS = {}    # xato turi -> soni
+UPLOAD_STATS = {}   # Telegramga yuklangan baytlar
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # label -> [bucket_counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self.lock:
+            s = self.series.get(label)
+            if s is None:
+                s = self.series[label] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def render(self, label_name):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label, (counts, total, count) in sorted(self.series.items()):
+                for b, c in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label_name}="{label}",le="{b}"}} {c}')
+                lines.append(f'{self.name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label_name}="{label}"}} {total:.6f}')
+                lines.append(f'{self.name}_count{{{label_name}="{label}"}} {count}')
+        return lines
+
+stage_latency = Histogram("musicbot_stage_seconds", "Bosqichlar davomiyligi (sekund)")
+
+@contextmanager
+def timed(stage):
+    # ✅ bosqich vaqti xato bo'lsa ham yoziladi
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        stage_latency.observe(stage, time.monotonic() - start)
+
+def record_error(e):
+    stat_inc(ERROR_STATS, type(e).__name__)
+
+# youtube.com/watch?v=, youtu.be/, shorts/, embed/, live/, music.youtube.com
+YOUTUBE_ID_RE = re.compile(
+    r"(?:https?://)?(?:www\.|m\.|music\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^#\s]*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)"
+    r"([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])",
+    re.IGNORECASE
+)
+
+class TTLCache:
+    # Xotirada cheklangan (LRU) va muddatli (TTL) kesh
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[1] < time.time():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return item[0] if item else None
+
+    def __len__(self):
+        return len(self.data)
+
+class TokenBucket:
+    # rate token/sek, capacity gacha yig'iladi; pause() -> 429 retry_after uchun
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            start = max(self.updated, self.paused_until)
+            if now > start:
+                self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+            self.updated = now
+
+    def try_take(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until or self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def take(self, n=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = max(self.paused_until - now, (n - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def wait_time(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return max(0.0, self.paused_until - now, (n - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+# instagram.com/p/<code>, /reel/<code>, /reels/<code>, /tv/<code> (username/ prefiks bilan ham)
+INSTAGRAM_CODE_RE = re.compile(r"instagram\.com/(?:[\w.]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]+)", re.IGNORECASE)
+
+def instagram_shortcode(text):
+    match = INSTAGRAM_CODE_RE.search(text or "")
+    return match.group(1) if match else None
+
+def yt_video_id(text):
+    # ✅ tarmoqsiz: link bo'lsa video id, aks holda None (qidiruv)
+    match = YOUTUBE_ID_RE.search(text or "")
+    return match.group(1) if match else None
+
+def youtube_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+# Har bir job o'z papkasida ishlaydi va faqat o'zinikini tozalaydi
+STALE_JOB_AGE = int(os.getenv("STALE_JOB_AGE", "3600"))
+
+@contextmanager
+def job_workdir():
+    path = tempfile.mkdtemp(prefix="job_", dir=DOWNLOAD_DIR)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def clear_stale_downloads(max_age=STALE_JOB_AGE):
+    # faqat egasi o'lib qolgan (crash) eski job papkalari/fayllari
+    now = time.time()
     for f in glob.glob(f"{DOWNLOAD_DIR}/*"):
         try:
-            if f.endswith(('.mp4', '.mp3', '.m4a', '.webm')):
+            if now - os.path.getmtime(f) < max_age:
+                continue
+            if os.path.isdir(f) and os.path.basename(f).startswith("job_"):
+                shutil.rmtree(f, ignore_errors=True)
+            elif f.endswith(('.mp4', '.mp3', '.m4a', '.webm')):
                 os.remove(f)
         except:
             pass
 
 def auto_clear_downloads(interval=300):
     while True:
-        clear_downloads()
+        clear_stale_downloads()
         time.sleep(interval)
 
 threading.Thread(target=auto_clear_downloads, daemon=True).start()
 
 # ================== STATS FUNKSIYALARI ==================
-def update_daily_stats(user_id=None, is_request=False):
-    today = datetime.now().strftime('%Y-%m-%d')
-    conn, c = get_db()
+# Hisoblagichlar xotirada; SQLite'ga vaqti-vaqti bilan rollup sifatida yoziladi
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "60"))
+STATS_WINDOW_DAYS = 30
+
+class HyperLogLog:
+    # unikal userlar soni taxmini: 4 KB xotira, ~1.6% xato
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+class StatsAggregator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = None
+        self.rollup = {
+            "today_users": 0, "month_users": 0, "today_requests": 0, "month_requests": 0,
+            "total_users": 0, "total_requests": 0,
+        }
+        self._load_day(datetime.now().strftime('%Y-%m-%d'))
+
+    def _load_day(self, today):
+        # bugungi holat + oldingi 30 kunlik birlashtirilgan sketch (bir marta, kun boshida)
+        since = (datetime.now() - timedelta(days=STATS_WINDOW_DAYS)).strftime('%Y-%m-%d')
+        row = db_fetchone("SELECT registers FROM stats_hll WHERE date = ?", (today,))
+        req = db_fetchone("SELECT COALESCE(requests_today, 0) FROM bot_stats WHERE date = ?", (today,))
+
+        past = HyperLogLog()
+        for (registers,) in db_fetchall("SELECT registers FROM stats_hll WHERE date >= ? AND date < ?", (since, today)):
+            past.merge(HyperLogLog(registers=registers))
+        past_req = db_fetchone(
+            "SELECT COALESCE(SUM(requests_today), 0) FROM bot_stats WHERE date >= ? AND date < ?", (since, today)
+        )[0]
+
+        self.day = today
+        self.hll = HyperLogLog(registers=row[0] if row else None)
+        self.requests = int(req[0]) if req else 0
+        self.past_hll = past
+        self.past_requests = int(past_req or 0)
+        self.dirty = False
+
+    def record(self, user_id=None, is_request=False):
+        today = datetime.now().strftime('%Y-%m-%d')
+        if today != self.day:
+            self.flush()
+            # _load_day o'qishidan oldin kechagi yozuvlar DB'ga tushsin
+            db_flush()
+            with self.lock:
+                if today != self.day:
+                    self._load_day(today)
+
+        with self.lock:
+            if user_id:
+                self.hll.add(user_id)
+            if is_request:
+                self.requests += 1
+            self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            day = self.day
+            registers = bytes(self.hll.registers)
+            today_users = self.hll.count()
+            today_requests = self.requests
+            month = HyperLogLog(registers=self.past_hll.registers).merge(self.hll)
+            month_requests = self.past_requests + today_requests
+            dirty, self.dirty = self.dirty, False
+
+        if dirty:
+            db_write(
+                "INSERT OR REPLACE INTO bot_stats (date, users_today, requests_today) VALUES (?,?,?)",
+                (day, today_users, today_requests)
+            )
+            db_write("INSERT OR REPLACE INTO stats_hll (date, registers) VALUES (?,?)", (day, registers))
+
+        self.rollup = {
+            "today_users": today_users,
+            "month_users": month.count(),
+            "today_requests": today_requests,
+            "month_requests": month_requests,
+            "total_users": db_fetchone("SELECT COUNT(*) FROM users")[0],
+            "total_requests": db_fetchone("SELECT COUNT(*) FROM music_requests")[0],
+        }
 
-    if user_id:
-        c.execute("UPDATE bot_stats SET users_today = users_today + 1 WHERE date = ?", (today,))
-        if c.rowcount == 0:
-            c.execute("INSERT INTO bot_stats (date, users_today) VALUES (?, 1)", (today,))
+stats_agg = StatsAggregator()
+stats_agg.flush()
+atexit.register(stats_agg.flush)
 
-    if is_request:
-        c.execute("UPDATE bot_stats SET requests_today = requests_today + 1 WHERE date = ?", (today,))
-        if c.rowcount == 0:
-            c.execute("INSERT INTO bot_stats (date, requests_today) VALUES (?, 1)", (today,))
+def on_sigterm(signum, frame):
+    # ✅ Render to'xtatishda SIGTERM yuboradi -> atexit ishlamaydi, shuning uchun o'zimiz yozamiz
+    print("⏹ SIGTERM: statistika saqlanmoqda...")
+    try:
+        stats_agg.flush()
+        db_flush()
+    finally:
+        kill_ytdl_workers()
+        os._exit(0)
 
-    conn.commit()
-    conn.close()
+signal.signal(signal.SIGTERM, on_sigterm)
+
+def auto_flush_stats():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            stats_agg.flush()
+        except Exception as e:
+            print("❌ Stats flush xato:", e)
+
+threading.Thread(target=auto_flush_stats, daemon=True).start()
+
+def update_daily_stats(user_id=None, is_request=False):
+    stats_agg.record(user_id, is_request)
 
 def get_monthly_stats():
-    conn, c = get_db()
-    today = datetime.now().strftime('%Y-%m-%d')
-
-    c.execute("""
-        SELECT COALESCE(users_today, 0), COALESCE(requests_today, 0)
-        FROM bot_stats WHERE date = ?
-    """, (today,))
-    today_row = c.fetchone()
-    today_users = int(today_row[0]) if today_row else 0
-    today_requests = int(today_row[1]) if today_row else 0
-
-    c.execute("""
-        SELECT COALESCE(SUM(users_today), 0), COALESCE(SUM(requests_today), 0)
-        FROM bot_stats
-        WHERE date >= date('now', '-30 days')
-    """)
-    month_row = c.fetchone()
-    month_users = int(float(month_row[0])) if month_row[0] is not None else 0
-    month_requests = int(float(month_row[1])) if month_row[1] is not None else 0
-
-    conn.close()
-    return today_users, month_users, today_requests, month_requests
+    r = stats_agg.rollup
+    return r["today_users"], r["month_users"], r["today_requests"], r["month_requests"]
 
 def get_channel_members_count(channel_username):
     try:
@@ -240,7 +744,10 @@ def get_channel_members_count(channel_username):
         return None
 
 
+_last_description = None
+
 def update_bot_description():
+    global _last_description
     try:
         today_users, month_users, today_requests, month_requests = get_monthly_stats()
 
@@ -267,8 +774,19 @@ def update_bot_description():
 🎶 Qo'shiqchi nomini yozing → Top 10
 📱 Instagram / YouTube link yuboring"""
 
+        # ✅ o'zgarmagan bo'lsa set_my_* chaqirmaymiz (restartdan keyin Telegramdagisi bilan solishtiramiz)
+        if _last_description is None:
+            _last_description = (
+                bot.get_my_short_description().short_description,
+                bot.get_my_description().description,
+            )
+        if _last_description == (short_desc, description):
+            print(f"ℹ️ Description o'zgarmagan | Subs: {subs_str}")
+            return
+
         bot.set_my_short_description(short_desc)
         bot.set_my_description(description)
+        _last_description = (short_desc, description)
 
         print(f"✅ Description yangilandi | Subs: {subs_str}")
 
@@ -276,20 +794,83 @@ def update_bot_description():
         print(f"❌ Description update xato:", e)
 
 def auto_update_stats():
+    # main'dan fon threadda ishga tushadi: tarmoq chaqiruvlari startup'ni ushlamaydi
     while True:
         update_bot_description()
         time.sleep(1800)
 
-threading.Thread(target=auto_update_stats, daemon=True).start()
+startup_mark("stats")
+
+# ================== RATE LIMIT (PER-USER) ==================
+# Har bir userga token bucket: so'rov turi bo'yicha narx. Tekshiruv xotirada, tarmoqsiz
+USER_RATE = float(os.getenv("USER_RATE", "0.2"))     # token/sek (5 sekundda 1 token)
+USER_BURST = float(os.getenv("USER_BURST", "6"))
+REQUEST_COSTS = {
+    "search": float(os.getenv("COST_SEARCH", "1")),
+    "audio": float(os.getenv("COST_AUDIO", "2")),
+    "instagram": float(os.getenv("COST_INSTAGRAM", "3")),
+}
+RATE_LIMIT_STATS = {}   # turi -> rad etilganlar
+user_buckets = TTLCache(maxsize=50000, ttl=3600)
+rate_notices = TTLCache(maxsize=50000, ttl=30)
+user_buckets_lock = threading.Lock()
+
+def request_kind(text):
+    if "instagram.com" in (text or "").lower():
+        return "instagram"
+    return "audio" if yt_video_id(text) else "search"
+
+def rate_limit_wait(user_id, kind):
+    # 0 -> ruxsat; aks holda necha sekund kutish kerak
+    if is_admin(user_id):
+        return 0
+    cost = REQUEST_COSTS[kind]
+    with user_buckets_lock:
+        bucket = user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(USER_RATE, USER_BURST)
+            user_buckets.set(user_id, bucket)
+    if bucket.try_take(cost):
+        return 0
+    stat_inc(RATE_LIMIT_STATS, kind)
+    return max(1, math.ceil(bucket.wait_time(cost)))
+
+def notify_rate_limited(user_id):
+    # ✅ flood paytida har xabarga javob yozmaymiz: 30 sekundda bitta ogohlantirish
+    if rate_notices.get(user_id):
+        return False
+    rate_notices.set(user_id, True)
+    return True
 
 # ================== SUBSCRIBE CHECK ==================
-def check_subscribe(user_id):
-    for ch in CHANNELS:
-        try:
+# Obuna holati keshlanadi: har xabarda get_chat_member chaqirmaymiz
+MEMBER_STATUSES = ("member", "administrator", "creator")
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", "600"))
+SUB_CACHE_NEG_TTL = int(os.getenv("SUB_CACHE_NEG_TTL", "30"))
+SUB_TRACK_UPDATES = os.getenv("SUB_TRACK_UPDATES", "").strip() == "1"
+sub_cache = TTLCache(int(os.getenv("SUB_CACHE_SIZE", "20000")), SUB_CACHE_TTL)
+
+def set_member_status(ch, user_id, status):
+    ok = status in MEMBER_STATUSES
+    sub_cache.set((ch, user_id), ok, ttl=SUB_CACHE_TTL if ok else SUB_CACHE_NEG_TTL)
+    return ok
+
+def is_member(ch, user_id, use_cache=True):
+    if use_cache:
+        cached = sub_cache.get((ch, user_id))
+        if cached is not None:
+            return cached
+    try:
+        with timed("subscription"):
             member = bot.get_chat_member(ch, user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                return False
-        except:
+    except:
+        # xatoni keshlamaymiz
+        return False
+    return set_member_status(ch, user_id, member.status)
+
+def check_subscribe(user_id, use_cache=True):
+    for ch in CHANNELS:
+        if not is_member(ch, user_id, use_cache):
             return False
     return True
 
@@ -300,49 +881,214 @@ def subscribe_markup():
     kb.add(types.InlineKeyboardButton("✅ Tekshirish", callback_data="check_sub"))
     return kb
 
-def save_user(user):
-    conn, c = get_db()
-    c.execute(
-        "INSERT OR REPLACE INTO users VALUES (?,?,?,?,?)",
-        (user.id, user.username, user.full_name, int(check_subscribe(user.id)), datetime.now().isoformat())
+def save_user(user, subscribed=None):
+    if subscribed is None:
+        subscribed = check_subscribe(user.id)
+    # user yozdi -> demak botni bloklamagan
+    db_write(
+        "INSERT OR REPLACE INTO users(user_id, username, full_name, subscribed, last_active, blocked) VALUES (?,?,?,?,?,0)",
+        (user.id, user.username, user.full_name, int(subscribed), datetime.now().isoformat())
     )
-    conn.commit()
-    conn.close()
 
 def save_music(user_id, query, url):
-    conn, c = get_db()
-    c.execute(
+    db_write(
         "INSERT INTO music_requests(user_id, query, yt_url, created_at) VALUES (?,?,?,?)",
         (user_id, query, url, datetime.now().isoformat())
     )
-    conn.commit()
-    conn.close()
+
+# ================== FILE_ID CACHE ==================
+# Bir marta yuborilgan fayl Telegram serverida qoladi -> file_id bilan qayta yuboramiz
+# mp3: har doim 192k mp3 | native: m4a o'zicha (transkodsiz), kerak bo'lsa -c:a copy
+AUDIO_DELIVERY_MODE = os.getenv("AUDIO_DELIVERY_MODE", "mp3").strip().lower()
+AUDIO_FORMAT = "mp3_192" if AUDIO_DELIVERY_MODE == "mp3" else "native"
+FILE_CACHE_STATS = {"hits": 0, "misses": 0, "invalid": 0, "saved": 0}
+
+def file_cache_key(video_id, fmt=AUDIO_FORMAT):
+    return f"yt:{video_id}:{fmt}"
+
+def get_cached_file_id(key):
+    row = db_fetchone("SELECT file_id FROM file_cache WHERE cache_key = ?", (key,))
+    if row:
+        db_write(
+            "UPDATE file_cache SET hits = hits + 1, last_used = ? WHERE cache_key = ?",
+            (datetime.now().isoformat(), key)
+        )
+
+    stat_inc(FILE_CACHE_STATS, "hits" if row else "misses")
+    return row[0] if row else None
+
+def save_file_id(key, file_id, kind="audio", title=None):
+    now = datetime.now().isoformat()
+    db_write(
+        "INSERT OR REPLACE INTO file_cache(cache_key, file_id, kind, title, hits, created_at, last_used) VALUES (?,?,?,?,0,?,?)",
+        (key, file_id, kind, title, now, now)
+    )
+    stat_inc(FILE_CACHE_STATS, "saved")
+
+def has_file_id(key):
+    return db_fetchone("SELECT 1 FROM file_cache WHERE cache_key = ?", (key,)) is not None
+
+def drop_file_id(key):
+    db_write("DELETE FROM file_cache WHERE cache_key = ?", (key,))
+
+def is_bad_file_id(e):
+    if not isinstance(e, apihelper.ApiTelegramException):
+        return False
+    text = str(e).lower()
+    return "file identifier" in text or "file_id" in text or "file reference" in text
+
+def sent_file_id(msg, kind):
+    media = getattr(msg, kind, None)
+    return media.file_id if media else None
+
+def send_cached(chat_id, key, kind="audio", **kwargs):
+    file_id = get_cached_file_id(key)
+    if not file_id:
+        return None
+
+    send = bot.send_audio if kind == "audio" else bot.send_video
+    try:
+        return send(chat_id, file_id, **kwargs)
+    except Exception as e:
+        if is_bad_file_id(e):
+            # file_id eskirgan -> keshdan o'chirib, qaytadan yuklaymiz
+            print(f"⚠️ file_id yaroqsiz ({key}):", e)
+            drop_file_id(key)
+            stat_inc(FILE_CACHE_STATS, "invalid")
+            return None
+        raise
 
 # ================== PROXY (YT-DLP) ==================
-# ENV: PROXY_URL=socks5h://IP:PORT  (socks5h tavsiya)
-PROXY_URL = os.getenv("PROXY_URL", "").strip()
-if PROXY_URL:
-    print("✅ Proxy yoqildi:", PROXY_URL.split("@")[-1])
+# ENV: PROXY_URL=socks5h://IP1:PORT,socks5h://IP2:PORT  (socks5h tavsiya, vergul bilan bir nechta)
+PROXY_URLS = [p for p in re.split(r"[,\s]+", os.getenv("PROXY_URL", "")) if p]
+PROXY_ALLOW_DIRECT = os.getenv("PROXY_ALLOW_DIRECT", "1").strip() == "1"
+PROXY_PROBE_URL = os.getenv("PROXY_PROBE_URL", "https://www.youtube.com/generate_204")
+PROXY_PROBE_INTERVAL = int(os.getenv("PROXY_PROBE_INTERVAL", "60"))
+PROXY_FAIL_THRESHOLD = int(os.getenv("PROXY_FAIL_THRESHOLD", "3"))
+PROXY_COOLDOWN = int(os.getenv("PROXY_COOLDOWN", "120"))
+PROXY_MAX_ATTEMPTS = int(os.getenv("PROXY_MAX_ATTEMPTS", "2"))
+PROXY_NET_ERRORS = ("socks", "timed out", "timeout", "proxy", "connection", "tunnel", "unreachable")
+DIRECT = ""  # yt-dlp uchun proxy="" -> to'g'ridan-to'g'ri ulanish
+
+def proxy_name(url):
+    return url.split("@")[-1] if url else "direct"
+
+def is_network_error(e):
+    text = str(e).lower()
+    return any(marker in text for marker in PROXY_NET_ERRORS)
+
+class ProxyState:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.ok = 0
+        self.failed = 0
+        self.streak = 0
+        self.open_until = 0.0
+        self.last_error = None
+
+    def success_rate(self):
+        total = self.ok + self.failed
+        return self.ok / total if total else 1.0
+
+    def score(self):
+        # kichik = yaxshi: tezlik / ishonchlilik
+        latency = self.latency if self.latency is not None else 1.0
+        return latency / max(self.success_rate(), 0.05)
+
+class ProxyPool:
+    def __init__(self, urls, allow_direct):
+        self.lock = threading.Lock()
+        self.states = [ProxyState(u) for u in urls]
+        if allow_direct or not urls:
+            self.states.append(ProxyState(DIRECT))
+
+    def pick(self, exclude=()):
+        now = time.time()
+        with self.lock:
+            candidates = [st for st in self.states if st.url not in exclude]
+            if not candidates:
+                return None
+            closed = [st for st in candidates if st.open_until <= now]
+            # ✅ direct faqat zaxira: proxy'lar ishlab turganda latency bo'yicha raqobat qilmaydi
+            proxies = [st for st in closed if st.url != DIRECT]
+            if proxies:
+                return min(proxies, key=ProxyState.score).url
+            if closed:
+                return closed[0].url
+            # hammasi "ochiq" (circuit breaker) -> eng tez tiklanadiganini sinab ko'ramiz
+            return min(candidates, key=lambda st: st.open_until).url
+
+    def report(self, url, ok, latency=None, error=None):
+        with self.lock:
+            st = next((st for st in self.states if st.url == url), None)
+            if st is None:
+                return
+            if ok:
+                st.ok += 1
+                st.streak = 0
+                st.open_until = 0.0
+                if latency is not None:
+                    st.latency = latency if st.latency is None else 0.7 * st.latency + 0.3 * latency
+            else:
+                st.failed += 1
+                st.streak += 1
+                st.last_error = str(error)[:120] if error else None
+                if st.streak >= PROXY_FAIL_THRESHOLD:
+                    st.open_until = time.time() + PROXY_COOLDOWN
+                    print(f"⚠️ Proxy vaqtincha o'chirildi ({PROXY_COOLDOWN}s):", proxy_name(url))
+
+    def probe(self, st):
+        proxies = {"http": st.url, "https": st.url} if st.url else None
+        start = time.time()
+        try:
+            # ENV proxy'lar probe natijasini buzmasin
+            with requests.Session() as session:
+                session.trust_env = False
+                session.get(PROXY_PROBE_URL, proxies=proxies, timeout=10).raise_for_status()
+            self.report(st.url, True, time.time() - start)
+        except Exception as e:
+            self.report(st.url, False, error=e)
+
+    def probe_all(self):
+        for st in list(self.states):
+            self.probe(st)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            return [{
+                "name": proxy_name(st.url),
+                "ok": st.ok,
+                "failed": st.failed,
+                "latency_ms": int(st.latency * 1000) if st.latency is not None else None,
+                "open": st.open_until > now,
+            } for st in self.states]
+
+proxy_pool = ProxyPool(PROXY_URLS, PROXY_ALLOW_DIRECT) if PROXY_URLS else None
+
+def auto_probe_proxies():
+    while True:
+        proxy_pool.probe_all()
+        time.sleep(PROXY_PROBE_INTERVAL)
+
+if proxy_pool:
+    print("✅ Proxy yoqildi:", ", ".join(proxy_name(u) for u in PROXY_URLS))
+    threading.Thread(target=auto_probe_proxies, daemon=True).start()
 else:
     print("ℹ️ Proxy o‘chiq (PROXY_URL yo‘q)")
 
 # ================== YT-DLP OPTS (BASE) ==================
+# Timeout/retry'lar operatsiya profiliga qarab (YTDLP_PROFILE_SETTINGS)
+YTDLP_VERBOSE = os.getenv("YTDLP_VERBOSE", "").strip() == "1"
 YTDLP_BASE_OPTS = {
-    "quiet": False,
-    "verbose": True,
+    "quiet": not YTDLP_VERBOSE,
+    "verbose": YTDLP_VERBOSE,
+    "no_warnings": not YTDLP_VERBOSE,
     "noplaylist": True,
-    "socket_timeout": 30,
     "nocheckcertificate": True,
-    "retries": 5,
-    "fragment_retries": 5,
-    "extractor_retries": 5,
-    "sleep_interval": 2,
-    "max_sleep_interval": 5,
-    "concurrent_fragment_downloads": 1,
-    "retries": 10,
-    "fragment_retries": 10,
-    "extractor_retries": 10,
-    "socket_timeout": 90,
+    # DASH/HLS fragmentlar parallel (ranged_download esa oddiy http uchun)
+    "concurrent_fragment_downloads": int(os.getenv("CONCURRENT_FRAGMENTS", "4")),
     "http_headers": {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
     },
@@ -353,9 +1099,7 @@ YTDLP_BASE_OPTS = {
     },
 }
 
-# ✅ proxy’ni base opts’ga ulaymiz
-if PROXY_URL:
-    YTDLP_BASE_OPTS["proxy"] = PROXY_URL
+# proxy har bir so'rov uchun proxy_pool orqali tanlanadi (ytdl_routed)
 
 def debug_cookies(path):
     try:
@@ -367,121 +1111,1556 @@ def debug_cookies(path):
     except Exception as e:
         print("debug_cookies error:", e)
 
-# ✅ 1) YouTube cookiesni tiklaymiz
-cookie_path = ensure_cookies_file()
+# Cookies birinchi yt-dlp chaqiruvida (yoki fon warm-up'da) tiklanadi -> startup'ni sekinlashtirmaydi
+ig_cookie_path = None
+_cookies_ready = False
+_cookies_lock = threading.Lock()
 
-# ✅ 2) YouTube cookiefile ni ulaymiz
-if cookie_path and os.path.exists(cookie_path) and os.path.getsize(cookie_path) > 100:
-    YTDLP_BASE_OPTS["cookiefile"] = cookie_path
-    print("✅ yt-dlp cookiefile ulandi:", cookie_path)
-    debug_cookies(cookie_path)
-else:
-    print("❌ cookiefile ulanmagan yoki juda kichik:", cookie_path)
+def setup_cookies():
+    global ig_cookie_path, _cookies_ready
+    if _cookies_ready:
+        return
+    with _cookies_lock:
+        if _cookies_ready:
+            return
+
+        # ✅ 1) YouTube cookiesni tiklaymiz
+        cookie_path = ensure_cookies_file()
+
+        # ✅ 2) YouTube cookiefile ni ulaymiz
+        if cookie_path and os.path.exists(cookie_path) and os.path.getsize(cookie_path) > 100:
+            YTDLP_BASE_OPTS["cookiefile"] = cookie_path
+            print("✅ yt-dlp cookiefile ulandi:", cookie_path)
+            debug_cookies(cookie_path)
+        else:
+            print("❌ cookiefile ulanmagan yoki juda kichik:", cookie_path)
+
+        # ✅ 3) Instagram cookiesni tiklaymiz (alohida)
+        ig_cookie_path = ensure_ig_cookies_file()
+        _cookies_ready = True
+
+# ================== YT-DLP POOL ==================
+# Uzoq yashovchi worker processlar (ytdl_worker.py): har birida profil bo'yicha tayyor (warm) YoutubeDL
+AUDIO_FORMAT_SELECTOR = "bestaudio/best" if AUDIO_DELIVERY_MODE == "mp3" else "bestaudio[ext=m4a]/bestaudio/best"
+
+# qidiruv tez bo'lishi kerak: kam retry, qisqa timeout; yuklash esa chidamliroq
+YTDLP_PROFILE_SETTINGS = {
+    "search": {"socket_timeout": 10, "retries": 1, "extractor_retries": 1},
+    "meta": {"socket_timeout": 15, "retries": 2, "extractor_retries": 2},
+    "audio": {"socket_timeout": 30, "retries": 3, "fragment_retries": 5, "extractor_retries": 2},
+    "instagram": {"socket_timeout": 20, "retries": 2, "fragment_retries": 3, "extractor_retries": 2},
+}
 
-# ✅ 3) Instagram cookiesni tiklaymiz (alohida)
-ig_cookie_path = ensure_ig_cookies_file()
+# Har bir user so'rovi uchun umumiy muddat (navbat + yuklash + ffmpeg)
+SEARCH_DEADLINE = int(os.getenv("SEARCH_DEADLINE", "20"))
+DOWNLOAD_DEADLINE = int(os.getenv("DOWNLOAD_DEADLINE", "240"))
+INSTAGRAM_DEADLINE = int(os.getenv("INSTAGRAM_DEADLINE", "180"))
+
+class DeadlineExceeded(Exception):
+    pass
+
+class JobCancelled(DeadlineExceeded):
+    pass
+
+class Deadline:
+    def __init__(self, seconds):
+        self.at = time.time() + seconds
+        self.cancelled = False
+
+    def remaining(self):
+        return max(0.0, self.at - time.time())
+
+    def cancel(self):
+        # keyingi bosqich chegarasida to'xtaydi
+        self.cancelled = True
+        self.at = 0
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("bekor qilindi")
+        if time.time() >= self.at:
+            raise DeadlineExceeded("⏱ So'rov vaqti tugadi. Birozdan keyin qayta urinib ko'ring.")
+
+def ytdl_profile_opts(profile):
+    setup_cookies()
+    if profile == "search":
+        return {**YTDLP_BASE_OPTS, **YTDLP_PROFILE_SETTINGS["search"], "extract_flat": True}
+    if profile == "meta":
+        return {**YTDLP_BASE_OPTS, **YTDLP_PROFILE_SETTINGS["meta"], "skip_download": True}
+    if profile == "audio":
+        return {**YTDLP_BASE_OPTS, **YTDLP_PROFILE_SETTINGS["audio"], "format": AUDIO_FORMAT_SELECTOR}
+    if profile == "instagram":
+        opts = {**YTDLP_BASE_OPTS, **YTDLP_PROFILE_SETTINGS["instagram"], "format": "mp4/best"}
+        # ✅ IG uchun proxy'ni butunlay o'chiramiz
+        opts["proxy"] = ""
+        opts.pop("source_address", None)
+        # ✅ IG cookies bo‘lsa ishlatamiz
+        if ig_cookie_path and os.path.exists(ig_cookie_path) and os.path.getsize(ig_cookie_path) > 100:
+            opts["cookiefile"] = ig_cookie_path
+        return opts
+    raise ValueError(f"Noma'lum yt-dlp profil: {profile}")
+
+# worker muddatda o'zi to'xtamasa (masalan C kodda osilib qolsa) shuncha kutib, pool qayta yaratiladi
+YTDLP_KILL_GRACE = float(os.getenv("YTDLP_KILL_GRACE", "5"))
+_ytdl_pools_lock = threading.Lock()
+
+def _reset_ytdl_pool(lane, pool):
+    # kamdan-kam holat (worker yiqilgan/o'ldirilgan). Diqqat: bu fork threadli processdan bo'ladi.
+    # forkserver/spawn mos emas: ular workerda server.py'ni __mp_main__ sifatida qayta bajaradi
+    # (lock, bot, DB). Xavf kamaytirilgan, lekin yo'q emas: child faqat ytdl_worker + yt_dlp'ni ishlatadi,
+    # cookie/opts parent'da tayyor, yt_dlp parent'da import qilinmaydi (import lock ushlanmaydi)
+    with _ytdl_pools_lock:
+        if ytdl_pools.get(lane) is pool:
+            ytdl_pools[lane] = make_ytdl_pool(YTDLP_LANE_WORKERS[lane])
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _reap_overdue(lane, pool, future):
+    # ytdl_acquire tufayli bu chaqiruv navbatda emas, haqiqatan workerda ishlayapti
+    try:
+        future.result(timeout=YTDLP_KILL_GRACE)
+        return
+    except FuturesTimeout:
+        pass
+    except Exception:
+        return
+    print(f"⚠️ yt-dlp worker muddatdan keyin ham ishlayapti ({lane}), process o'ldirilmoqda...")
+    procs = list((pool._processes or {}).values())
+    _reset_ytdl_pool(lane, pool)
+    # ProcessPoolExecutor bitta worker o'lsa butun pool'ni buzilgan deb belgilaydi:
+    # shu lane'dagi boshqa chaqiruvlar BrokenProcessPool oladi va yangi pool'da qayta uriniladi
+    for proc in procs:
+        proc.kill()
+
+# ✅ lane'dagi chaqiruvlar soni workerlardan oshmaydi: pool'ning ichki navbatida hech narsa kutmaydi
+# (u yerdagi future ham RUNNING hisoblanadi -> muddati o'tsa cancel ishlamaydi, reaper adashadi).
+# Past prioritet (prefetch) faqat bo'sh worker bo'lsa va user chaqiruvlari kutmayotganda kiradi
+_ytdl_prio = threading.local()
+ytdl_lane_cond = threading.Condition()
+ytdl_lane_calls = {lane: 0 for lane in YTDLP_LANE_WORKERS}
+ytdl_lane_waiting = {lane: 0 for lane in YTDLP_LANE_WORKERS}
+
+@contextmanager
+def ytdl_low_priority():
+    _ytdl_prio.low = True
+    try:
+        yield
+    finally:
+        _ytdl_prio.low = False
+
+def ytdl_acquire(lane, deadline=None):
+    low = getattr(_ytdl_prio, "low", False)
+    with ytdl_lane_cond:
+        if not low:
+            ytdl_lane_waiting[lane] += 1
+        try:
+            while ytdl_lane_calls[lane] >= YTDLP_LANE_WORKERS[lane] or (low and ytdl_lane_waiting[lane]):
+                ytdl_lane_cond.wait(0.5)
+                if deadline:
+                    deadline.check()
+        finally:
+            if not low:
+                ytdl_lane_waiting[lane] -= 1
+        ytdl_lane_calls[lane] += 1
+
+def ytdl_release(lane):
+    with ytdl_lane_cond:
+        ytdl_lane_calls[lane] -= 1
+        ytdl_lane_cond.notify_all()
+
+def ytdl_call(profile, op, target, outtmpl=None, proxy=None, deadline=None):
+    deadline_at = deadline.at if deadline else None
+    if deadline:
+        deadline.check()
+    opts = ytdl_profile_opts(profile)
+
+    if not ytdl_pools:
+        try:
+            return ytdl_worker.run(profile, opts, op, target, outtmpl, proxy, deadline_at)
+        except YtdlpError:
+            if deadline:
+                deadline.check()
+            raise
+
+    lane = YTDLP_LANES[profile]
+    for _ in range(2):
+        ytdl_acquire(lane, deadline)
+        pool = ytdl_pools[lane]
+        try:
+            future = pool.submit(ytdl_worker.run, profile, opts, op, target, outtmpl, proxy, deadline_at)
+        except BrokenProcessPool:
+            ytdl_release(lane)
+            print(f"⚠️ yt-dlp pool buzilgan ({lane}), qayta yaratilmoqda...")
+            _reset_ytdl_pool(lane, pool)
+            continue
+        # slot worker haqiqatan bo'shaguncha band (timeout'dan keyin ham)
+        future.add_done_callback(lambda f, lane=lane: ytdl_release(lane))
+        try:
+            return future.result(timeout=deadline.remaining() if deadline else None)
+        except FuturesTimeout:
+            # worker o'zi SIGALRM bilan to'xtaydi; userga darhol javob beramiz, osilib qolsa o'ldiriladi
+            if not future.cancel():
+                threading.Thread(target=_reap_overdue, args=(lane, pool, future), daemon=True, name="ytdl-reaper").start()
+            deadline.check()
+            raise
+        except YtdlpError:
+            if deadline:
+                deadline.check()
+            raise
+        except BrokenProcessPool:
+            # ✅ bitta worker yiqilsa bot ishlashda davom etadi
+            print(f"⚠️ yt-dlp worker yiqildi ({lane}), pool qayta yaratilmoqda...")
+            _reset_ytdl_pool(lane, pool)
+    raise Exception("yt-dlp worker ishdan chiqdi")
+
+def ytdl_extract(profile, target, proxy=None, deadline=None):
+    return ytdl_call(profile, "extract", target, proxy=proxy, deadline=deadline)[0]
+
+def ytdl_routed(fn, deadline=None, measure=True):
+    # ✅ marshrut oldindan tanlanadi (latency/success bo'yicha); tarmoq xatosida keyingisi
+    if not proxy_pool:
+        return fn(None)
+
+    tried = []
+    while True:
+        proxy = proxy_pool.pick(exclude=tried)
+        tried.append(proxy)
+        start = time.time()
+        try:
+            result = fn(proxy)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not is_network_error(e):
+                raise
+            proxy_pool.report(proxy, False, error=e)
+            if len(tried) >= PROXY_MAX_ATTEMPTS or proxy_pool.pick(exclude=tried) is None:
+                raise
+            if deadline:
+                deadline.check()
+            print(f"⚠️ {proxy_name(proxy)} ishlamadi, boshqa marshrut bilan urinayapman...")
+            continue
+        # yuklash vaqti proxy latency emas -> faqat qisqa so'rovlarni o'lchaymiz
+        proxy_pool.report(proxy, True, time.time() - start if measure else None)
+        return result
 
 # ✅ 4) Bot start bo‘lganda 1 marta test
 def quick_test():
     test_url = "https://www.youtube.com/watch?v=KFWhRKh-bZo"
     try:
-        opts = {**YTDLP_BASE_OPTS, "skip_download": True}
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(test_url, download=False)
-            print("✅ TEST OK title:", info.get("title"))
+        info = ytdl_routed(lambda proxy: ytdl_extract("meta", test_url, proxy))
+        print("✅ TEST OK title:", info.get("title"))
     except Exception as e:
         print("❌ TEST FAIL:", repr(e))
 
 
+# ================== SEARCH CACHE ==================
+# Bir xil qidiruv natijalari hamma userlar uchun umumiy (xotira + SQLite)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600)))
+search_cache = TTLCache(int(os.getenv("SEARCH_CACHE_SIZE", "1000")), SEARCH_CACHE_TTL)
+# har bir userning oxirgi Top 10 ro'yxati (tugmalar uchun)
+user_search_cache = TTLCache(int(os.getenv("USER_CACHE_SIZE", "5000")), int(os.getenv("USER_CACHE_TTL", "3600")))
+
+def normalize_query(text):
+    return " ".join((text or "").lower().split())
+
+def search_cache_get(query):
+    results = search_cache.get(query)
+    if results is not None:
+        return results
+
+    row = db_fetchone("SELECT results, created_at FROM search_cache WHERE query = ?", (query,))
+
+    if row and time.time() - row[1] < SEARCH_CACHE_TTL:
+        results = json.loads(row[0])
+        search_cache.set(query, results, ttl=SEARCH_CACHE_TTL - (time.time() - row[1]))
+        return results
+    return None
+
+def search_cache_put(query, results):
+    search_cache.set(query, results)
+    now = time.time()
+    db_write(
+        "INSERT OR REPLACE INTO search_cache(query, results, created_at) VALUES (?,?,?)",
+        (query, json.dumps(results, ensure_ascii=False), now)
+    )
+    db_write("DELETE FROM search_cache WHERE created_at < ?", (now - SEARCH_CACHE_TTL,))
+
+def find_user_song(user_id, video_id):
+    for song in user_search_cache.get(user_id) or []:
+        if song.get("id") == video_id:
+            return song
+    return None
+
+# ================== LOCAL INDEX (FTS5) ==================
+# Yuborilgan treklar: nom + qidiruv so'rovlari, mashhurlik (plays) bo'yicha tartib
+# LOCAL_SEARCH: off | merge (lokal top + YouTube) | prefer (LOCAL_FRESH_DAYS ichida yetarli trek bo'lsa
+# YouTube kutilmaydi: lokal ro'yxat + keshdagi YouTube natijasi, kesh eskirgan bo'lsa fonda yangilanadi)
+LOCAL_SEARCH = os.getenv("LOCAL_SEARCH", "merge").strip().lower()
+LOCAL_MIN_RESULTS = int(os.getenv("LOCAL_MIN_RESULTS", "5"))
+# "a", "dj" kabi qisqa so'rovlar deyarli hamma trekka mos keladi -> lokal indeks ishlatilmaydi
+LOCAL_MIN_QUERY_LEN = int(os.getenv("LOCAL_MIN_QUERY_LEN", "3"))
+LOCAL_MERGE_TOP = int(os.getenv("LOCAL_MERGE_TOP", "3"))
+LOCAL_FRESH_DAYS = int(os.getenv("LOCAL_FRESH_DAYS", "30"))
+LOCAL_SEARCH_STATS = {"local": 0, "merged": 0, "remote": 0, "inline": 0}
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def index_track(video_id, title, query=None, duration=None, played_at=None):
+    if not video_id:
+        return
+    query = normalize_query(query)
+    db_write(
+        """INSERT INTO tracks(video_id, title, queries, duration, plays, last_played) VALUES (?,?,?,?,1,?)
+        ON CONFLICT(video_id) DO UPDATE SET
+            title = COALESCE(excluded.title, title),
+            duration = COALESCE(NULLIF(excluded.duration, 0), duration),
+            queries = CASE WHEN excluded.queries = '' OR instr(queries, excluded.queries) > 0 THEN queries
+                           ELSE substr(queries || ' ' || excluded.queries, 1, 1000) END,
+            plays = plays + 1,
+            last_played = excluded.last_played""",
+        (video_id, title, query, int(duration or 0), played_at or time.time())
+    )
+    if FTS_ENABLED:
+        db_write("DELETE FROM tracks_fts WHERE rowid = (SELECT id FROM tracks WHERE video_id = ?)", (video_id,))
+        db_write("INSERT INTO tracks_fts(rowid, title, queries) SELECT id, title, queries FROM tracks WHERE video_id = ?", (video_id,))
+
+def fts_query(text):
+    # har bir so'z prefiks sifatida: "emin"* "lose"*; juda qisqa so'z faqat aynan mos keladi
+    return " ".join(f'"{w}"*' if len(w) >= LOCAL_MIN_QUERY_LEN else f'"{w}"'
+                    for w in WORD_RE.findall((text or "").lower())[:8])
+
+def local_search(text, limit=10, fresh_days=LOCAL_FRESH_DAYS, with_file=False):
+    since = time.time() - fresh_days * 86400 if fresh_days else 0
+    file_join = "JOIN" if with_file else "LEFT JOIN"
+    select = (
+        "SELECT t.video_id, t.title, t.duration, f.file_id FROM {src} "
+        f"{file_join} file_cache f ON f.cache_key = 'yt:' || t.video_id || ':' || ? "
+    )
+    words = WORD_RE.findall((text or "").lower())[:8]
+
+    if not words:
+        # bo'sh so'rov (inline) -> eng mashhurlari
+        sql = select.format(src="tracks t") + "WHERE t.last_played >= ? ORDER BY t.plays DESC LIMIT ?"
+        params = (AUDIO_FORMAT, since, limit)
+    elif FTS_ENABLED:
+        # ✅ bm25 (kichik = yaxshi, manfiy) mashhurlik bilan kuchaytiriladi
+        sql = select.format(src="tracks_fts JOIN tracks t ON t.id = tracks_fts.rowid") + (
+            "WHERE tracks_fts MATCH ? AND t.last_played >= ? "
+            "ORDER BY bm25(tracks_fts) * (1.0 + 0.1 * MIN(t.plays, 100)) LIMIT ?"
+        )
+        params = (AUDIO_FORMAT, fts_query(text), since, limit)
+    else:
+        like = " AND ".join("(t.title LIKE ? OR t.queries LIKE ?)" for _ in words)
+        sql = select.format(src="tracks t") + f"WHERE {like} AND t.last_played >= ? ORDER BY t.plays DESC LIMIT ?"
+        params = (AUDIO_FORMAT, *[f"%{w}%" for w in words for _ in (0, 1)], since, limit)
+
+    try:
+        rows = db_fetchall(sql, params)
+    except sqlite3.OperationalError as e:
+        print("⚠️ Lokal qidiruv xato:", e)
+        return []
+    return [{
+        "id": video_id,
+        "title": title or video_id,
+        "url": youtube_url(video_id),
+        "duration": duration or 0,
+        "file_id": file_id,
+        "local": True,
+    } for video_id, title, duration, file_id in rows]
+
+def backfill_tracks():
+    # bir martalik: music_requests tarixidan indeks (tracks bo'sh bo'lsa)
+    if db_fetchone("SELECT 1 FROM tracks LIMIT 1"):
+        return 0
+    count = 0
+    for yt_url, title, plays, last in db_fetchall(
+        "SELECT yt_url, MAX(query), COUNT(*), MAX(created_at) FROM music_requests GROUP BY yt_url"
+    ):
+        video_id = yt_video_id(yt_url)
+        if not video_id:
+            continue
+        try:
+            played_at = datetime.fromisoformat(last).timestamp()
+        except (TypeError, ValueError):
+            played_at = time.time()
+        db_write(
+            "INSERT OR IGNORE INTO tracks(video_id, title, queries, duration, plays, last_played) VALUES (?,?,'',0,?,?)",
+            (video_id, title, plays, played_at)
+        )
+        count += 1
+    if FTS_ENABLED:
+        # shu orada index_track qo'shganlari takrorlanmasin
+        db_write(
+            "INSERT INTO tracks_fts(rowid, title, queries) SELECT id, title, queries FROM tracks "
+            "WHERE id NOT IN (SELECT rowid FROM tracks_fts)"
+        )
+    if count:
+        print(f"✅ Lokal indeks to'ldirildi: {count} trek")
+    return count
+
 # ================== MUSIC FUNCTIONS ==================
-def search_artist_top10(artist_name):
-    opts = {**YTDLP_BASE_OPTS, "extract_flat": True}
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(f"ytsearch10:{artist_name}", download=False)
-        entries = info.get("entries") or []
-        results = []
-        for i, entry in enumerate(entries[:10], 1):
-            results.append({
-                "title": entry.get("title", f"Qo'shiq {i}"),
-                "url": f"https://www.youtube.com/watch?v={entry.get('id', '')}",
-                "duration": entry.get("duration", 0),
-                "number": i
-            })
+search_refreshing = set()
+search_refresh_lock = threading.Lock()
+
+def refresh_search_async(artist_name):
+    # ✅ stale-while-revalidate: user lokal javobni kutmasdan oladi, YouTube natijasi fonda yangilanadi
+    query = normalize_query(artist_name)
+    with search_refresh_lock:
+        if query in search_refreshing:
+            return
+        search_refreshing.add(query)
+
+    def work():
+        try:
+            with ytdl_low_priority():
+                remote_search_top10(artist_name, Deadline(SEARCH_DEADLINE))
+        except Exception as e:
+            print("⚠️ Fon qidiruv yangilash xato:", e)
+        finally:
+            with search_refresh_lock:
+                search_refreshing.discard(query)
+
+    threading.Thread(target=work, daemon=True, name="search-refresh").start()
+
+def search_artist_top10(artist_name, deadline=None):
+    query = normalize_query(artist_name)
+    if LOCAL_SEARCH not in ("merge", "prefer") or len(query) < LOCAL_MIN_QUERY_LEN:
+        return remote_search_top10(artist_name, deadline)
+
+    local = local_search(artist_name)
+    if LOCAL_SEARCH == "prefer" and len(local) >= LOCAL_MIN_RESULTS:
+        # ✅ indeksda LOCAL_FRESH_DAYS ichida yetarli trek -> YouTube'ni kutmaymiz;
+        # bo'sh o'rinlar keshdagi YouTube natijasidan, kesh yo'q/eskirgan bo'lsa fonda yangilanadi
+        remote = search_cache_get(query)
+        if remote is None:
+            refresh_search_async(artist_name)
+            remote = []
+        stat_inc(LOCAL_SEARCH_STATS, "local")
+        top = local
+    else:
+        remote = remote_search_top10(artist_name, deadline)
+        top = local[:LOCAL_MERGE_TOP]
+        stat_inc(LOCAL_SEARCH_STATS, "merged" if top else "remote")
+
+    seen = {song["id"] for song in top}
+    results = top + [song for song in remote if song["id"] not in seen]
+    return [{**song, "query": query, "number": i} for i, song in enumerate(results[:10], 1)]
+
+def remote_search_top10(artist_name, deadline=None):
+    query = normalize_query(artist_name)
+    results = search_cache_get(query)
+    if results is not None:
         return results
 
-# ✅ Instagram download: base opts + IG cookies (bo‘lsa)
-def download_instagram(url, timeout=60):
-    opts = {
-        **YTDLP_BASE_OPTS,
-        "outtmpl": f"{DOWNLOAD_DIR}/%(id)s_%(title).50s.%(ext)s",
-        "format": "mp4/best",
-        "quiet": True,
-        "noplaylist": True,
-        "socket_timeout": timeout,
-    }
-
-    # ✅ IG uchun proxy'ni butunlay o'chiramiz
-    opts["proxy"] = ""          # opts darajada proxy disable
-    opts.pop("source_address", None)
-
-    # ✅ IG cookies bo‘lsa ishlatamiz
-    if ig_cookie_path and os.path.exists(ig_cookie_path) and os.path.getsize(ig_cookie_path) > 100:
-        opts["cookiefile"] = ig_cookie_path
-
-    # ✅ ENG MUHIMI: IG so‘rov paytida ENV proxy'larni vaqtincha o‘chirib turamiz
-    with temp_unset_env(PROXY_ENV_KEYS):
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            return ydl.prepare_filename(info)
-        
-def extract_audio(video_path):
-    audio_path = video_path.replace(".mp4", ".mp3")
-    result = subprocess.run(
-        ["ffmpeg", "-i", video_path, "-vn", "-ab", "192k", audio_path, "-y"],
+    with timed("search"):
+        info = ytdl_routed(lambda proxy: ytdl_extract("search", f"ytsearch10:{artist_name}", proxy, deadline), deadline)
+    entries = info.get("entries") or []
+    results = []
+    for i, entry in enumerate(entries[:10], 1):
+        results.append({
+            "id": entry.get("id", ""),
+            "title": entry.get("title", f"Qo'shiq {i}"),
+            "url": youtube_url(entry.get("id", "")),
+            "duration": entry.get("duration", 0),
+            "number": i
+        })
+
+    search_cache_put(query, results)
+    return results
+
+# ================== PARALLEL DOWNLOAD ==================
+# Katta fayllar: bir nechta HTTP Range so'rov parallel, ulanishlar soni tezlikka qarab moslashadi
+RANGED_DOWNLOAD = os.getenv("RANGED_DOWNLOAD", "1").strip() == "1"
+RANGED_MIN_BYTES = int(float(os.getenv("RANGED_MIN_MB", "8")) * 1024 * 1024)
+RANGED_CHUNK_BYTES = int(float(os.getenv("RANGED_CHUNK_MB", "1")) * 1024 * 1024)
+RANGED_MAX_CONNECTIONS = int(os.getenv("RANGED_MAX_CONNECTIONS", "8"))
+RANGED_HOST_LIMIT = int(os.getenv("RANGED_HOST_LIMIT", "6"))
+DOWNLOAD_STATS = {"ranged": 0, "serial": 0, "streamed": 0, "bytes": 0}
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def host_slot(url):
+    # bitta hostga jami ulanishlar soni cheklangan (barcha yuklashlar bo'yicha)
+    host = urllib.parse.urlparse(url).hostname or ""
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(RANGED_HOST_LIMIT)
+        return slot
+
+def http_session(proxy=None):
+    # proxy: None -> ENV bo'yicha, "" -> to'g'ridan-to'g'ri, aks holda shu proxy
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=RANGED_MAX_CONNECTIONS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if proxy is not None:
+        session.trust_env = False
+        if proxy:
+            session.proxies = {"http": proxy, "https": proxy}
+    return session
+
+def serial_download(url, dst, headers=None, proxy=None, deadline=None, timeout=30):
+    with http_session(proxy) as session, host_slot(url):
+        with session.get(url, headers=headers or {}, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            with open(dst, "wb") as f:
+                for block in r.iter_content(64 * 1024):
+                    if deadline:
+                        deadline.check()
+                    f.write(block)
+    return os.path.getsize(dst)
+
+def _range_size(session, url, headers, timeout):
+    with session.get(url, headers={**headers, "Range": "bytes=0-0"}, timeout=timeout, stream=True) as r:
+        if r.status_code != 206:
+            return None
+        total = r.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+
+def ranged_download(url, dst, headers=None, proxy=None, size=None, deadline=None, timeout=30):
+    headers = dict(headers or {})
+    session = http_session(proxy)
+    fd = None
+    try:
+        size = size or _range_size(session, url, headers, timeout)
+        if not size:
+            # server Range'ni qo'llamaydi
+            return serial_download(url, dst, headers, proxy, deadline, timeout)
+
+        chunks = deque((start, min(start + RANGED_CHUNK_BYTES, size) - 1) for start in range(0, size, RANGED_CHUNK_BYTES))
+        cond = threading.Condition()
+        state = {"target": min(2, RANGED_MAX_CONNECTIONS), "active": 0, "bytes": 0, "error": None, "alive": 0}
+        finished = threading.Event()
+        slot = host_slot(url)
+
+        with open(dst, "wb") as f:
+            f.truncate(size)
+        fd = os.open(dst, os.O_WRONLY)
+
+        def fetch(start, end):
+            for attempt in range(3):
+                pos = start
+                try:
+                    if deadline:
+                        deadline.check()
+                    with slot:
+                        r = session.get(url, headers={**headers, "Range": f"bytes={start}-{end}"}, timeout=timeout, stream=True)
+                        with r:
+                            if r.status_code != 206:
+                                raise Exception(f"Range qo'llanmadi: HTTP {r.status_code}")
+                            for block in r.iter_content(64 * 1024):
+                                os.pwrite(fd, block, pos)
+                                pos += len(block)
+                                with cond:
+                                    state["bytes"] += len(block)
+                    if pos != end + 1:
+                        raise Exception("Chunk to'liq kelmadi")
+                    return
+                except DeadlineExceeded:
+                    raise
+                except Exception:
+                    with cond:
+                        state["bytes"] -= pos - start
+                    if attempt == 2:
+                        raise
+
+        def worker():
+            try:
+                while True:
+                    with cond:
+                        while state["active"] >= state["target"] and chunks and not state["error"]:
+                            cond.wait(0.2)
+                        if not chunks or state["error"]:
+                            return
+                        start, end = chunks.popleft()
+                        state["active"] += 1
+                    try:
+                        fetch(start, end)
+                    except Exception as e:
+                        with cond:
+                            state["error"] = state["error"] or e
+                    finally:
+                        with cond:
+                            state["active"] -= 1
+                            cond.notify_all()
+            finally:
+                with cond:
+                    state["alive"] -= 1
+                    if not state["alive"]:
+                        finished.set()
+
+        state["alive"] = RANGED_MAX_CONNECTIONS
+        for _ in range(RANGED_MAX_CONNECTIONS):
+            threading.Thread(target=worker, daemon=True).start()
+
+        # ✅ moslashuvchan parallellik: tezlik oshsa ulanish qo'shamiz, tushsa kamaytiramiz
+        best = 0.0
+        last_bytes, last_t = 0, time.time()
+        while not finished.wait(0.5):
+            now = time.time()
+            with cond:
+                done = state["bytes"]
+                rate = (done - last_bytes) / max(now - last_t, 1e-6)
+                last_bytes, last_t = done, now
+                if rate > best * 1.1:
+                    best = rate
+                    if state["target"] < RANGED_MAX_CONNECTIONS:
+                        state["target"] += 1
+                        cond.notify_all()
+                elif rate < best * 0.7 and state["target"] > 1:
+                    state["target"] -= 1
+
+        if state["error"]:
+            raise state["error"]
+        return size
+    finally:
+        if fd is not None:
+            os.close(fd)
+        session.close()
+
+def fetch_media(profile, info, outtmpl, workdir, proxy=None, deadline=None):
+    size = info.get("filesize") or info.get("filesize_approx") or 0
+    with timed("download"):
+        if RANGED_DOWNLOAD and info.get("protocol") in ("http", "https") and info.get("url") and size >= RANGED_MIN_BYTES:
+            path = os.path.join(workdir, f"{info.get('id') or 'media'}.{info.get('ext') or 'bin'}")
+            # IG har doim proxysiz
+            http_proxy = "" if profile == "instagram" else proxy
+            ranged_download(info["url"], path, info.get("http_headers"), http_proxy, info.get("filesize"), deadline)
+            stat_inc(DOWNLOAD_STATS, "ranged")
+        else:
+            _, path = ytdl_call(profile, "process", info, outtmpl=outtmpl, proxy=proxy, deadline=deadline)
+            stat_inc(DOWNLOAD_STATS, "serial")
+
+    if os.path.exists(path):
+        stat_inc(DOWNLOAD_STATS, "bytes", os.path.getsize(path))
+    return path
+
+# ✅ Instagram download: IG profil (proxysiz + IG cookies)
+def download_instagram(url, workdir, deadline=None):
+    outtmpl = os.path.join(workdir, "%(id)s_%(title).50s.%(ext)s")
+    with timed("metadata"):
+        info, _ = ytdl_call("instagram", "extract", url, deadline=deadline)
+    return fetch_media("instagram", info, outtmpl, workdir, deadline=deadline), info
+
+# ================== FFMPEG ==================
+TRANSCODE_STATS = {
+    "passthrough": 0, "remuxed": 0, "transcoded": 0,
+    "ffmpeg_cpu": 0.0, "transcoded_audio_sec": 0, "passthrough_audio_sec": 0,
+}
+PASSTHROUGH_EXTS = ("m4a", "mp3")
+
+def run_ffmpeg(args, deadline=None, stage="transcode"):
+    if deadline:
+        deadline.check()
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL
     )
-    if result.returncode != 0:
-        raise Exception("FFmpeg audio ajratishda xatolik")
+    killer = threading.Timer(deadline.remaining(), proc.kill) if deadline else None
+    if killer:
+        killer.daemon = True
+        killer.start()
+
+    # ✅ wait4 -> aynan shu ffmpeg jarayonining CPU vaqti
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        if killer:
+            killer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    stage_latency.observe(stage, time.monotonic() - start)
+
+    cpu = usage.ru_utime + usage.ru_stime
+    stat_inc(TRANSCODE_STATS, "ffmpeg_cpu", cpu)
+    if proc.returncode != 0:
+        if deadline:
+            deadline.check()
+        raise Exception("FFmpeg xatolik")
+    return cpu
+
+def transcode_mp3(src, dst, headers=None, deadline=None, kbps=192):
+    args = []
+    stage = "transcode"
+    if src.startswith("http"):
+        # tarmoq + encode birga -> alohida bosqich (sof "transcode" vaqtini buzmaydi)
+        stage = "download_transcode"
+        # ✅ ffmpeg streamni o'zi o'qiydi: yuklash va encode bir vaqtda
+        if headers:
+            args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        args += ["-reconnect", "1", "-reconnect_streamed", "1"]
+    args += ["-i", src, "-vn", "-c:a", "libmp3lame", "-b:a", f"{kbps}k", dst]
+    run_ffmpeg(args, deadline, stage)
+    return dst
+
+def remux_audio(src, dst, deadline=None):
+    run_ffmpeg(["-i", src, "-vn", "-c:a", "copy", dst], deadline)
+    return dst
+
+def cpu_saved_estimate():
+    st = dict(TRANSCODE_STATS)
+    if not st["transcoded_audio_sec"]:
+        return 0.0
+    per_sec = st["ffmpeg_cpu"] / st["transcoded_audio_sec"]
+    return per_sec * st["passthrough_audio_sec"]
+
+def extract_audio(video_path, deadline=None, acodec=None):
+    # ✅ kengaytma qanday bo'lmasin, natija manba bilan to'qnashmaydi (x.m4a -> x.audio.m4a)
+    base = os.path.splitext(video_path)[0] + ".audio"
+    acodec = (acodec or "").lower()
+    ext = os.path.splitext(video_path)[1].lower().lstrip(".")
+
+    # IG videolarida AAC bor -> qayta encode qilmasdan ko'chiramiz
+    if acodec.startswith("mp4a") or (not acodec and ext in ("mp4", "m4a", "mov")):
+        try:
+            audio_path = remux_audio(video_path, base + ".m4a", deadline)
+            stat_inc(TRANSCODE_STATS, "remuxed")
+            return audio_path
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print("⚠️ Audio copy bo'lmadi, encode qilamiz:", e)
+
+    audio_path = transcode_mp3(video_path, base + ".mp3", deadline=deadline)
+    stat_inc(TRANSCODE_STATS, "transcoded")
     return audio_path
 
-def download_mp3_from_url(yt_url, title):
-    opts = {
-        **YTDLP_BASE_OPTS,
-        "format": "bestaudio/best",
-        "outtmpl": f"{DOWNLOAD_DIR}/%(id)s_%(title).50s.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-    }
+# ================== FORMAT TANLASH (UPLOAD LIMIT) ==================
+# Bot API upload limiti 50 MB: davomiylik + format hajmidan kelib chiqib eng arzon mos stream/bitrate
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "49")) * 1024 * 1024)
+MP3_BITRATES = (192, 160, 128, 96, 64)
+SIZE_MARGIN = 1.03  # konteyner/teglar uchun zaxira
+MAX_AUDIO_DURATION = int(MAX_UPLOAD_BYTES * 8 / (MP3_BITRATES[-1] * 1000 * SIZE_MARGIN))
+FORMAT_STATS = {"refused": 0, "downgraded": 0}
+
+class TooLarge(Exception):
+    pass
+
+def too_large_text(duration):
+    return (f"⛔ Juda uzun: {duration // 60} daqiqa. "
+            f"Telegram limiti sabab ~{MAX_AUDIO_DURATION // 60} daqiqagacha yuboriladi.")
+
+def mp3_bitrate_for(duration):
+    # sig'adigan eng yuqori bitrate; hech biri sig'masa None
+    for kbps in MP3_BITRATES:
+        if not duration or kbps * 1000 / 8 * duration * SIZE_MARGIN <= MAX_UPLOAD_BYTES:
+            return kbps
+    return None
+
+def format_size(fmt, duration):
+    # hajm noma'lum bo'lsa davomiylik x bitrate; buni ham bilib bo'lmasa None
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and duration and (fmt.get("abr") or fmt.get("tbr")):
+        size = (fmt.get("abr") or fmt.get("tbr")) * 1000 / 8 * duration
+    return size or None
+
+def format_fits(fmt, duration):
+    # ✅ noma'lum hajm sig'maydi deb hisoblanadi (aks holda 50 MB'dan katta fayl yuklanib ketadi)
+    size = format_size(fmt, duration)
+    return size is not None and size * SIZE_MARGIN <= MAX_UPLOAD_BYTES
+
+def choose_audio_format(info):
+    # -> (info, mp3_kbps). mp3_kbps None: fayl o'zicha (passthrough/remux) yuboriladi
+    duration = int(info.get("duration") or 0)
+    kbps = mp3_bitrate_for(duration)
+    if kbps is None:
+        stat_inc(FORMAT_STATS, "refused")
+        raise TooLarge(too_large_text(duration))
+
+    formats = [
+        f for f in info.get("formats") or []
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none") and f.get("url")
+    ]
+    if not formats:
+        # formatlar ro'yxati yo'q -> yt-dlp tanlagani qoladi
+        fits = format_fits(info, duration)
+        return info, (None if AUDIO_DELIVERY_MODE != "mp3" and fits else kbps)
+
+    chosen, out_kbps = None, kbps
+    if AUDIO_DELIVERY_MODE != "mp3":
+        # ✅ native: sig'adigan eng sifatli stream (m4a birinchi -> ffmpegsiz)
+        fitting = [f for f in formats if format_fits(f, duration)]
+        if fitting:
+            chosen = max(fitting, key=lambda f: (f.get("ext") in PASSTHROUGH_EXTS, f.get("abr") or f.get("tbr") or 0))
+            out_kbps = None
+
+    if chosen is None:
+        # mp3: maqsad bitratedan past bo'lmagan eng kichik manba (ortiqcha trafik yo'q)
+        enough = [f for f in formats if (f.get("abr") or f.get("tbr") or 0) >= kbps]
+        if enough:
+            chosen = min(enough, key=lambda f: format_size(f, duration) or float("inf"))
+        else:
+            chosen = max(formats, key=lambda f: f.get("abr") or f.get("tbr") or 0)
+        if kbps < MP3_BITRATES[0]:
+            stat_inc(FORMAT_STATS, "downgraded")
+
+    # yt-dlp qayta tanlaganda faqat shu format qoladi
+    selected = {k: v for k, v in info.items() if k not in ("requested_formats", "requested_downloads")}
+    selected.update(chosen)
+    selected["formats"] = [chosen]
+    return selected, out_kbps
+
+def _stream_url_ok(info, proxy):
+    # socks proxy'ni ffmpeg bilmaydi; fragmentli formatlarni yt-dlp yuklaydi
+    return not proxy and info.get("protocol") in ("http", "https") and bool(info.get("url"))
+
+def _download_audio(yt_url, workdir, proxy=None, deadline=None):
+    outtmpl = os.path.join(workdir, "%(id)s_%(title).50s.%(ext)s")
+    with timed("metadata"):
+        info = ytdl_extract("audio", yt_url, proxy=proxy, deadline=deadline)
+    # ✅ limitdan oshsa shu yerda to'xtaydi: bironta bayt yuklanmaydi
+    info, kbps = choose_audio_format(info)
+    duration = int(info.get("duration") or 0)
+    base = os.path.join(workdir, info.get("id") or "audio")
+
+    if kbps is None and info.get("ext") in PASSTHROUGH_EXTS:
+        path = fetch_media("audio", info, outtmpl, workdir, proxy, deadline)
+        stat_inc(TRANSCODE_STATS, "passthrough")
+        stat_inc(TRANSCODE_STATS, "passthrough_audio_sec", duration)
+        return path, info.get("title")
+
+    if kbps and _stream_url_ok(info, proxy):
+        path = transcode_mp3(info["url"], base + ".mp3", info.get("http_headers"), deadline, kbps)
+        # ✅ fetch_media chetlab o'tildi: ffmpeg o'qigan hajm formatdan (yo'q bo'lsa davomiylik x bitrate)
+        stat_inc(DOWNLOAD_STATS, "streamed")
+        stat_inc(DOWNLOAD_STATS, "bytes", int(format_size(info, duration) or 0))
+    else:
+        src = fetch_media("audio", info, outtmpl, workdir, proxy, deadline)
+        if kbps is None and (info.get("acodec") or "").startswith("mp4a"):
+            path = remux_audio(src, base + ".m4a", deadline)
+            stat_inc(TRANSCODE_STATS, "remuxed")
+            stat_inc(TRANSCODE_STATS, "passthrough_audio_sec", duration)
+            return path, info.get("title")
+        # fallback: to'liq encode
+        path = transcode_mp3(src, base + ".mp3", deadline=deadline, kbps=kbps or mp3_bitrate_for(duration) or MP3_BITRATES[-1])
+
+    stat_inc(TRANSCODE_STATS, "transcoded")
+    stat_inc(TRANSCODE_STATS, "transcoded_audio_sec", duration)
+    return path, info.get("title")
+
+def download_audio_from_url(yt_url, title, workdir, deadline=None):
+    # stream URL proxy IP'siga bog'langan -> yuklash ham shu marshrutda
+    audio_path, info_title = ytdl_routed(lambda proxy: _download_audio(yt_url, workdir, proxy, deadline), deadline, measure=False)
+
+    if not os.path.exists(audio_path):
+        raise Exception("Audio fayl topilmadi")
+    # baribir katta chiqsa upload'ga urinmaymiz
+    if os.path.getsize(audio_path) > MAX_UPLOAD_BYTES:
+        stat_inc(FORMAT_STATS, "refused")
+        raise TooLarge(f"⛔ Fayl juda katta: {os.path.getsize(audio_path) / 1024 / 1024:.0f} MB")
+    return audio_path, yt_url, title or info_title
+
+# ================== AUDIO DISK CACHE ==================
+# Yuklangan fayllar hajm limiti (LRU) va TTL bilan diskda saqlanadi
+AUDIO_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "cache")
+AUDIO_CACHE_MAX_BYTES = int(float(os.getenv("AUDIO_CACHE_MAX_MB", "500")) * 1024 * 1024)
+AUDIO_CACHE_TTL = int(os.getenv("AUDIO_CACHE_TTL", str(7 * 24 * 3600)))
+AUDIO_CACHE_STATS = {"hits": 0, "misses": 0, "stored": 0, "evicted_files": 0, "evicted_bytes": 0}
+os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+audio_cache_lock = threading.Lock()
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def audio_cache_get(key):
+    now = time.time()
+    row = db_fetchone("SELECT path, created_at FROM audio_cache WHERE cache_key = ?", (key,))
+
+    path = None
+    if row and now - row[1] < AUDIO_CACHE_TTL and os.path.exists(row[0]):
+        path = row[0]
+        db_write("UPDATE audio_cache SET last_access = ? WHERE cache_key = ?", (now, key))
+    elif row:
+        db_write("DELETE FROM audio_cache WHERE cache_key = ?", (key,))
+        _remove_file(row[0])
+
+    stat_inc(AUDIO_CACHE_STATS, "hits" if path else "misses")
+    return path
+
+def audio_cache_put(key, src_path):
+    ext = os.path.splitext(src_path)[1]
+    dst = os.path.join(AUDIO_CACHE_DIR, key.replace(":", "_").replace("/", "_") + ext)
+    shutil.move(src_path, dst)
+
+    now = time.time()
+    db_write(
+        "INSERT OR REPLACE INTO audio_cache(cache_key, path, size, created_at, last_access) VALUES (?,?,?,?,?)",
+        (key, dst, os.path.getsize(dst), now, now)
+    )
+
+    stat_inc(AUDIO_CACHE_STATS, "stored")
+    audio_cache_evict()
+    return dst
+
+def audio_cache_evict():
+    with audio_cache_lock:
+        # navbatdagi yozuvlar ko'rinishi uchun avval flush
+        db_flush()
+        rows = db_fetchall("SELECT cache_key, path, size, created_at FROM audio_cache ORDER BY last_access")
+
+        now = time.time()
+        total = sum(r[2] or 0 for r in rows)
+        for key, path, size, created_at in rows:
+            expired = now - created_at >= AUDIO_CACHE_TTL
+            missing = not os.path.exists(path)
+            if not (expired or missing or total > AUDIO_CACHE_MAX_BYTES):
+                continue
+
+            db_write("DELETE FROM audio_cache WHERE cache_key = ?", (key,))
+            _remove_file(path)
+            total -= size or 0
+            if not missing:
+                stat_inc(AUDIO_CACHE_STATS, "evicted_files")
+                stat_inc(AUDIO_CACHE_STATS, "evicted_bytes", size or 0)
+
+        return total
+
+def audio_cache_usage():
+    return db_fetchone("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_cache")
+
+# ================== SINGLE-FLIGHT ==================
+# Bir xil video uchun parallel so'rovlar: bittasi yuklaydi, qolganlari natijani kutadi
+SINGLEFLIGHT_STATS = {"leaders": 0, "shared": 0}
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, fn, deadline=None):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+
+        if not leader:
+            if not flight.event.wait(deadline.remaining() if deadline else None):
+                deadline.check()
+            if flight.error is not None:
+                raise flight.error
+            stat_inc(SINGLEFLIGHT_STATS, "shared")
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.event.set()
+
+        stat_inc(SINGLEFLIGHT_STATS, "leaders")
+        return flight.result, False
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.flights)
+
+audio_flights = SingleFlight()
+
+def upload_file(send, chat_id, path, **kw):
+    # ✅ Telegramga yuklash vaqti va hajmi /metrics uchun
+    with timed("upload"), open(path, "rb") as f:
+        msg = send(chat_id, f, **kw)
+    stat_inc(UPLOAD_STATS, "bytes", os.path.getsize(path))
+    return msg
+
+def send_audio_file(chat_id, path, title):
+    return upload_file(bot.send_audio, chat_id, path, title=title)
+
+file_flights = SingleFlight()
+
+def fetch_audio_file(yt_url, title, key, deadline=None):
+    # ✅ diskdagi keshda bo'lsa qayta yuklamaymiz; bo'lmasa bir video = bitta yuklash
+    path = audio_cache_get(key)
+    if path:
+        return path, yt_url, title
+
+    def work():
+        with job_workdir() as workdir:
+            audio_path, url, info_title = download_audio_from_url(yt_url, title, workdir, deadline)
+            return audio_cache_put(key, audio_path), url, info_title
+
+    while True:
+        try:
+            result, _ = file_flights.do(key, work, deadline)
+            return result
+        except JobCancelled:
+            if deadline and deadline.cancelled:
+                raise
+            # bekor qilingan prefetch'ni kutgan edik -> o'zimiz yuklaymiz
+
+def upload_audio(chat_id, yt_url, title, key=None, deadline=None):
+    if not key:
+        with job_workdir() as workdir:
+            audio_path, url, title = download_audio_from_url(yt_url, title, workdir, deadline)
+            msg = send_audio_file(chat_id, audio_path, title)
+        return sent_file_id(msg, "audio"), url, title
+
+    for attempt in range(2):
+        path, url, title = fetch_audio_file(yt_url, title, key, deadline)
+        try:
+            msg = send_audio_file(chat_id, path, title)
+            break
+        except FileNotFoundError:
+            # LRU shu orada o'chirib yuborgan
+            if attempt:
+                raise
+
+    file_id = sent_file_id(msg, "audio")
+    if file_id:
+        save_file_id(key, file_id, "audio", title)
+    return file_id, url, title
+
+def deliver_audio(chat_id, yt_url, title, deadline=None):
+    video_id = yt_video_id(yt_url)
+    if not video_id:
+        _, url, title = upload_audio(chat_id, yt_url, title, deadline=deadline)
+        return url, title
+
+    key = file_cache_key(video_id)
+
+    # ✅ avval file_id kesh: yuklash/ffmpeg/upload yo'q
+    if send_cached(chat_id, key, "audio", title=title):
+        return yt_url, title
+
+    (file_id, url, shared_title), shared = audio_flights.do(
+        key, lambda: upload_audio(chat_id, yt_url, title, key, deadline), deadline
+    )
+    if not shared:
+        return url, shared_title
+
+    # ✅ boshqa so'rov allaqachon yuklagan: file_id bilan tarqatamiz
+    if file_id:
+        bot.send_audio(chat_id, file_id, title=title)
+        return url, title
+
+    _, url, title = upload_audio(chat_id, yt_url, title, key, deadline)
+    return url, title
+
+# ================== DOWNLOAD QUEUE ==================
+# Og'ir ishlar (yt-dlp/ffmpeg/upload) alohida workerlarda: handlerlar darhol qaytadi
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "3"))
+DOWNLOAD_QUEUE_MAX = int(os.getenv("DOWNLOAD_QUEUE_MAX", "50"))
+PER_USER_JOBS = int(os.getenv("PER_USER_JOBS", "2"))
+
+class QueueFull(Exception):
+    pass
+
+class DownloadJob:
+    def __init__(self, chat_id, user_id, fn, *args, timeout=DOWNLOAD_DEADLINE, low=False):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        # low: fon ishi (prefetch) -> userga xabar yubormaydi
+        self.low = low
+        # muddat navbatga qo'yilgan paytdan boshlab hisoblanadi
+        self.deadline = Deadline(timeout)
+        self.notice = None
+        self.notice_ready = threading.Event()
+
+    def run(self):
+        try:
+            self.deadline.check()
+            self.fn(self, *self.args)
+        except JobCancelled as e:
+            record_error(e)
+            if not self.low:
+                bot.send_message(self.chat_id, "❌ So'rov bekor qilindi")
+        except TooLarge as e:
+            record_error(e)
+            if not self.low:
+                bot.send_message(self.chat_id, str(e))
+        except Exception as e:
+            record_error(e)
+            if self.low:
+                print("⚠️ Fon ishi xato:", e)
+                return
+            bot.send_message(self.chat_id, f"❌ Xatolik: {e}")
+            print("FULL TRACE:\n", traceback.format_exc())
+        finally:
+            # navbat xabari hali yuborilmagan bo'lishi mumkin
+            self.notice_ready.wait(10)
+            if self.notice:
+                try:
+                    bot.delete_message(self.chat_id, self.notice.message_id)
+                except:
+                    pass
+
+class DownloadScheduler:
+    # Har bir user uchun alohida navbat, userlar orasida round-robin
+    def __init__(self, workers, max_queue, per_user, low_max=1, low_queue_max=20):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_user = per_user
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.ready = deque()
+        self.user_jobs = {}
+        self.pending = 0
+        self.running = 0
+        # past prioritetli navbat: o'zining low_max threadlari (user workerlari byudjetidan tashqari),
+        # navbatda user ishi turganda yangisi boshlanmaydi
+        self.low = deque()
+        self.low_max = low_max
+        self.low_queue_max = low_queue_max
+        self.low_running = set()
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, daemon=True, name=f"download-{i}").start()
+        for i in range(low_max):
+            threading.Thread(target=self._worker, args=(True,), daemon=True, name=f"prefetch-{i}").start()
+
+    def submit(self, job):
+        with self.cond:
+            active = self.user_jobs.get(job.user_id, 0)
+            if active >= self.per_user:
+                raise QueueFull(f"⛔ Sizda allaqachon {active} ta yuklash bor. Avval ular tugashini kuting.")
+            if self.pending >= self.max_queue:
+                raise QueueFull("⛔ Hozir navbat to'la. Birozdan keyin qayta urinib ko'ring.")
+
+            q = self.queues.setdefault(job.user_id, deque())
+            if not q:
+                self.ready.append(job.user_id)
+            q.append(job)
+            self.user_jobs[job.user_id] = active + 1
+            self.pending += 1
+
+            # round-robin: har bir boshqa userdan ko'pi bilan (k+1) ta ish oldinda
+            k = len(q) - 1
+            ahead = k + sum(min(len(other), k + 1) for uid, other in self.queues.items() if uid != job.user_id)
+            free = self.workers - self.running
+            self.cond.notify_all()
+            return max(0, ahead + 1 - free)
+
+    def submit_low(self, job):
+        with self.cond:
+            if not self.low_max or len(self.low) >= self.low_queue_max:
+                return False
+            self.low.append(job)
+            self.cond.notify_all()
+            return True
+
+    def cancel_low(self, user_id):
+        with self.cond:
+            queued = [j for j in self.low if j.user_id == user_id]
+            self.low = deque(j for j in self.low if j.user_id != user_id)
+            running = [j for j in self.low_running if j.user_id == user_id]
+        for job in running:
+            job.deadline.cancel()
+        return len(queued) + len(running)
+
+    def _next_low(self):
+        with self.cond:
+            while not self.low or self.pending:
+                self.cond.wait()
+            job = self.low.popleft()
+            self.low_running.add(job)
+            return job
+
+    def _next(self, low=False):
+        if low:
+            return self._next_low()
+        with self.cond:
+            while not self.ready:
+                self.cond.wait()
+
+            user_id = self.ready.popleft()
+            q = self.queues[user_id]
+            job = q.popleft()
+            if q:
+                self.ready.append(user_id)
+            else:
+                del self.queues[user_id]
+            self.pending -= 1
+            self.running += 1
+            if not self.pending:
+                # prefetch threadlari navbat bo'shashini kutadi
+                self.cond.notify_all()
+            return job
+
+    def _done(self, job):
+        with self.cond:
+            if job.low:
+                self.low_running.discard(job)
+                return
+            self.running -= 1
+            left = self.user_jobs.get(job.user_id, 1) - 1
+            if left > 0:
+                self.user_jobs[job.user_id] = left
+            else:
+                self.user_jobs.pop(job.user_id, None)
+
+    def _worker(self, low=False):
+        while True:
+            job = self._next(low)
+            try:
+                job.run()
+            except Exception:
+                print("❌ Worker xato:\n", traceback.format_exc())
+            finally:
+                self._done(job)
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "running": self.running, "pending": self.pending, "workers": self.workers,
+                "low_running": len(self.low_running), "low_pending": len(self.low),
+            }
+
+# ================== PREFETCH ==================
+# Top 10 ko'rsatilgach, user tanlaguncha birinchi N tasini diskdagi keshga oldindan yuklaymiz
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", "0"))
+PREFETCH_MAX_RUNNING = int(os.getenv("PREFETCH_MAX_RUNNING", "1"))
+PREFETCH_QUEUE_MAX = int(os.getenv("PREFETCH_QUEUE_MAX", "20"))
+PREFETCH_STATS = {"queued": 0, "done": 0, "skipped": 0, "dropped": 0, "cancelled": 0}
+
+download_scheduler = DownloadScheduler(
+    DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_MAX, PER_USER_JOBS,
+    low_max=PREFETCH_MAX_RUNNING, low_queue_max=PREFETCH_QUEUE_MAX,
+)
+
+def prefetch_job(job, song):
+    key = file_cache_key(song["id"])
+    if has_file_id(key):
+        stat_inc(PREFETCH_STATS, "skipped")
+        return
+    with ytdl_low_priority():
+        fetch_audio_file(song["url"], song["title"], key, job.deadline)
+    stat_inc(PREFETCH_STATS, "done")
 
+def schedule_prefetch(user_id, results):
+    if PREFETCH_TOP_N <= 0:
+        return
+    for song in results[:PREFETCH_TOP_N]:
+        if not song.get("id") or int(song.get("duration") or 0) > MAX_AUDIO_DURATION:
+            continue
+        job = DownloadJob(None, user_id, prefetch_job, song, low=True)
+        job.notice_ready.set()
+        if download_scheduler.submit_low(job):
+            stat_inc(PREFETCH_STATS, "queued")
+        else:
+            # global byudjet to'la
+            stat_inc(PREFETCH_STATS, "dropped")
+            break
+
+def cancel_prefetch(user_id):
+    if PREFETCH_TOP_N > 0:
+        cancelled = download_scheduler.cancel_low(user_id)
+        if cancelled:
+            stat_inc(PREFETCH_STATS, "cancelled", cancelled)
+
+def enqueue_download(chat_id, user_id, fn, *args, timeout=DOWNLOAD_DEADLINE):
+    job = DownloadJob(chat_id, user_id, fn, *args, timeout=timeout)
     try:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            ydl.download([yt_url])
+        position = download_scheduler.submit(job)
+    except QueueFull as e:
+        bot.send_message(chat_id, str(e))
+        return None
 
-    except Exception as e:
-        if "Socks" in str(e) or "timed out" in str(e):
-            print("⚠️ Proxy muammo. Proxysiz qayta urinayapman...")
-            opts.pop("proxy", None)
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                ydl.download([yt_url])
+    try:
+        if position:
+            text = f"⏳ Navbatdasiz: {position}-o'rin. Kuting..."
         else:
-            raise
+            text = "⏳ Qo'shiq yuklanmoqda..."
+        job.notice = bot.send_message(chat_id, text)
+    finally:
+        job.notice_ready.set()
+    return job
+
+def song_job(job, song):
+    url, title = deliver_audio(job.chat_id, song["url"], song["title"], job.deadline)
+    save_music(job.user_id, title, url)
+    index_track(yt_video_id(url), title, song.get("query"), song.get("duration"))
+
+IG_VIDEO_CAPTION = "🎥 Video + Original Musiqa"
+IG_AUDIO_TITLE = "🔊 Ovoz (Musiqasiz)"
+# audio ajratish video upload bilan parallel (ffmpeg alohida process, thread faqat kutadi)
+ig_audio_pool = ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix="ig-audio")
+
+def send_and_cache(send, chat_id, path, key, kind, **kw):
+    msg = upload_file(send, chat_id, path, **kw)
+    file_id = sent_file_id(msg, kind)
+    if key and file_id:
+        save_file_id(key, file_id, kind)
+    return msg
+
+def instagram_job(job, url):
+    # ✅ shortcode bo'yicha kesh: qayta ulashilgan reel yuklashsiz yuboriladi
+    code = instagram_shortcode(url)
+    video_key = f"ig:{code}:video" if code else None
+    audio_key = f"ig:{code}:audio" if code else None
+
+    video_sent = bool(code and send_cached(job.chat_id, video_key, "video", caption=IG_VIDEO_CAPTION))
+    if video_sent and send_cached(job.chat_id, audio_key, "audio", title=IG_AUDIO_TITLE):
+        return
+
+    with job_workdir() as workdir:
+        video_path, info = download_instagram(url, workdir, job.deadline)
+
+        has_ffmpeg = bool(shutil.which("ffmpeg"))
+        audio_future = None
+        if has_ffmpeg:
+            audio_future = ig_audio_pool.submit(extract_audio, video_path, job.deadline, info.get("acodec"))
+
+        try:
+            if not video_sent:
+                send_and_cache(bot.send_video, job.chat_id, video_path, video_key, "video", caption=IG_VIDEO_CAPTION)
+        finally:
+            # workdir o'chirilishidan oldin ffmpeg tugashi kerak
+            if audio_future:
+                futures_wait([audio_future])
+
+        if not has_ffmpeg:
+            bot.send_message(job.chat_id, "❌ FFmpeg topilmadi.")
+            return
+
+        send_and_cache(bot.send_audio, job.chat_id, audio_future.result(), audio_key, "audio", title=IG_AUDIO_TITLE)
+
+def search_one_job(job, text_in):
+    with timed("search"):
+        info = ytdl_routed(lambda proxy: ytdl_extract("search", f"ytsearch1:{text_in}", proxy, job.deadline), job.deadline)
+    entry = (info.get("entries") or [None])[0]
+    if not entry:
+        raise Exception("Natija topilmadi")
+    if int(entry.get("duration") or 0) > MAX_AUDIO_DURATION:
+        stat_inc(FORMAT_STATS, "refused")
+        raise TooLarge(too_large_text(int(entry["duration"])))
+    yt_url = youtube_url(entry.get("id"))
+
+    url, title = deliver_audio(job.chat_id, yt_url, text_in, job.deadline)
+    save_music(job.chat_id, title, url)
+    index_track(entry.get("id"), entry.get("title") or title, text_in, entry.get("duration"))
+
+# ================== BROADCAST ==================
+# Telegram limiti: ~30 xabar/sek (global). Har bir userga bitta xabar -> per-chat limit o'z-o'zidan saqlanadi
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_REPORT_INTERVAL = int(os.getenv("BROADCAST_REPORT_INTERVAL", "10"))
+BROADCAST_MAX_RETRIES = 3
+BLOCKED_ERRORS = ("blocked", "deactivated", "chat not found", "user not found", "can't initiate")
+# boshida to'la bucket -> birinchi soniyada ko'p xabar ketmasin: burst kichik
+BROADCAST_BURST = float(os.getenv("BROADCAST_BURST", "3"))
+# webhook rejimida bir nechta replika: broadcast'ni faqat lease olgan replika yuboradi
+BROADCAST_OWNER = f"{os.uname().nodename}:{os.getpid()}"
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "120"))
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+broadcast_lock = threading.Lock()
+active_broadcast = None
+
+def retry_after(e):
+    if isinstance(e, apihelper.ApiTelegramException) and e.error_code == 429:
+        params = (e.result_json or {}).get("parameters") or {}
+        return int(params.get("retry_after") or 1)
+    return None
+
+def is_blocked_error(e):
+    if not isinstance(e, apihelper.ApiTelegramException):
+        return False
+    text = str(e).lower()
+    return e.error_code in (400, 403) and any(s in text for s in BLOCKED_ERRORS)
+
+def claim_broadcast(broadcast_id):
+    # ✅ atomik: faqat bitta replika oladi; egasi o'lsa lease tugagach boshqasi davom ettiradi
+    now = time.time()
+    _, c = get_db()
+    c.execute(
+        "UPDATE broadcasts SET owner = ?, lease_until = ? WHERE id = ? AND status = 'running' "
+        "AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+        (BROADCAST_OWNER, now + BROADCAST_LEASE, broadcast_id, BROADCAST_OWNER, now)
+    )
+    return c.rowcount == 1
+
+class Broadcast:
+    def __init__(self, row):
+        (self.id, self.admin_chat_id, self.from_chat_id, self.message_id, self.text,
+         self.last_user_id, self.total, self.sent, self.failed, self.blocked) = row
+        self.stop = threading.Event()
+        self.lost = False
+        self.status_msg = None
+
+    def send_one(self, user_id):
+        if self.stop.is_set():
+            return None
+        for _ in range(BROADCAST_MAX_RETRIES):
+            broadcast_bucket.take()
+            try:
+                if self.message_id:
+                    bot.copy_message(user_id, self.from_chat_id, self.message_id)
+                else:
+                    bot.send_message(user_id, self.text)
+                return "sent"
+            except Exception as e:
+                wait = retry_after(e)
+                if wait:
+                    # ✅ 429: barcha senderlar retry_after davomida to'xtaydi
+                    broadcast_bucket.pause(wait)
+                    continue
+                if is_blocked_error(e):
+                    db_write("UPDATE users SET blocked = 1 WHERE user_id = ?", (user_id,))
+                    return "blocked"
+                return "failed"
+        return "failed"
+
+    def checkpoint(self, status):
+        db_write(
+            "UPDATE broadcasts SET status = ?, last_user_id = ?, sent = ?, failed = ?, blocked = ?, updated_at = ? "
+            "WHERE id = ? AND owner = ?",
+            (status, self.last_user_id, self.sent, self.failed, self.blocked, time.time(), self.id, BROADCAST_OWNER)
+        )
+
+    def report(self, rate, final=False):
+        done = self.sent + self.failed + self.blocked
+        left = max(0, self.total - done)
+        eta = f"~{int(left / rate)}s" if rate and not final else "—"
+        head = "✅ Broadcast tugadi" if final and not self.stop.is_set() else ("⏹ Broadcast to'xtatildi" if final else "📣 Broadcast")
+        text = (f"{head} #{self.id}\n"
+                f"📨 {done}/{self.total}\n"
+                f"✅ {self.sent} | 🚫 {self.blocked} | ❌ {self.failed}\n"
+                f"⚡ {rate:.1f} xabar/s | ⏳ {eta}")
+        try:
+            if self.status_msg:
+                bot.edit_message_text(text, self.admin_chat_id, self.status_msg.message_id)
+            else:
+                self.status_msg = bot.send_message(self.admin_chat_id, text)
+        except Exception as e:
+            print("⚠️ Broadcast hisobot xato:", e)
+
+    def run(self):
+        started = time.monotonic()
+        done_before = self.sent + self.failed + self.blocked
+        last_report = 0.0
+        rate = 0.0
+
+        with ThreadPoolExecutor(BROADCAST_WORKERS, thread_name_prefix=f"broadcast-{self.id}") as pool:
+            while not self.stop.is_set():
+                # har batch oldidan lease yangilanadi; boshqa replika olgan bo'lsa to'xtaymiz
+                if not claim_broadcast(self.id):
+                    self.lost = True
+                    break
+                # ✅ keyset pagination: butun jadval xotiraga olinmaydi
+                ids = [r[0] for r in db_fetchall(
+                    "SELECT user_id FROM users WHERE user_id > ? AND COALESCE(blocked, 0) = 0 ORDER BY user_id LIMIT ?",
+                    (self.last_user_id, BROADCAST_BATCH)
+                )]
+                if not ids:
+                    break
+
+                for result in pool.map(self.send_one, ids):
+                    if result == "sent":
+                        self.sent += 1
+                    elif result == "blocked":
+                        self.blocked += 1
+                    elif result == "failed":
+                        self.failed += 1
+                if self.stop.is_set():
+                    break
+
+                # checkpoint faqat to'liq batchdan keyin: restartda ko'pi bilan bitta batch qayta yuboriladi
+                self.last_user_id = ids[-1]
+                self.checkpoint("running")
+
+                elapsed = time.monotonic() - started
+                rate = (self.sent + self.failed + self.blocked - done_before) / elapsed if elapsed else 0.0
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    self.report(rate)
+
+        if self.lost:
+            print(f"⚠️ Broadcast #{self.id} boshqa replikaga o'tdi")
+            return
+        self.checkpoint("stopped" if self.stop.is_set() else "done")
+        self.report(rate, final=True)
+        print(f"📣 Broadcast #{self.id}: sent={self.sent} blocked={self.blocked} failed={self.failed}")
+
+def start_broadcast(row):
+    global active_broadcast
+    with broadcast_lock:
+        if active_broadcast:
+            return None
+        active_broadcast = Broadcast(row)
+
+    def runner(b):
+        global active_broadcast
+        try:
+            b.run()
+        except Exception:
+            print("❌ Broadcast xato:\n", traceback.format_exc())
+        finally:
+            with broadcast_lock:
+                active_broadcast = None
+
+    threading.Thread(target=runner, args=(active_broadcast,), daemon=True, name="broadcast").start()
+    return active_broadcast
+
+BROADCAST_COLUMNS = "id, admin_chat_id, from_chat_id, message_id, text, last_user_id, total, sent, failed, blocked"
+
+def create_broadcast(admin_chat_id, from_chat_id=None, message_id=None, text=None):
+    # yangi userlar ham navbatdan DB'ga tushsin
+    db_flush()
+    total = db_fetchone("SELECT COUNT(*) FROM users WHERE COALESCE(blocked, 0) = 0")[0]
+    now = time.time()
+    # id darhol kerak -> writer navbatisiz, to'g'ridan-to'g'ri yozamiz
+    _, c = get_db()
+    c.execute(
+        "INSERT INTO broadcasts(admin_chat_id, from_chat_id, message_id, text, status, total, created_at, updated_at, owner, lease_until) "
+        "VALUES (?,?,?,?,'running',?,?,?,?,?)",
+        (admin_chat_id, from_chat_id, message_id, text, total, now, now, BROADCAST_OWNER, now + BROADCAST_LEASE)
+    )
+    return db_fetchone(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (c.lastrowid,))
+
+def resume_broadcasts():
+    # restartdan keyin tugallanmagan broadcast checkpoint'dan davom etadi (egasiz yoki lease tugagan)
+    if active_broadcast:
+        return
+    row = db_fetchone(
+        f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' "
+        "AND (owner IS NULL OR owner = ? OR lease_until < ?) ORDER BY id LIMIT 1",
+        (BROADCAST_OWNER, time.time())
+    )
+    if not row or not claim_broadcast(row[0]):
+        return
+    if start_broadcast(row):
+        print(f"📣 Broadcast #{row[0]} davom ettirildi (user_id > {row[5]})")
+    else:
+        db_write("UPDATE broadcasts SET lease_until = 0 WHERE id = ? AND owner = ?", (row[0], BROADCAST_OWNER))
 
-    # ✅ ENG MUHIM QISM
-    mp3_files = glob.glob(f"{DOWNLOAD_DIR}/*.mp3")
-    if not mp3_files:
-        raise Exception("MP3 topilmadi")
+def auto_resume_broadcasts():
+    # egasi (boshqa replika) o'lib qolsa lease tugagach shu yerda davom etadi
+    while True:
+        try:
+            resume_broadcasts()
+        except Exception as e:
+            print("⚠️ Broadcast resume xato:", e)
+        time.sleep(BROADCAST_LEASE / 2)
 
-    mp3_path = max(mp3_files, key=os.path.getctime)
-    return mp3_path, yt_url, title
+startup_mark("modullar")
 
 # ================== CALLBACKS ==================
 @bot.callback_query_handler(func=lambda c: c.data == "check_sub")
 def check_cb(call):
-    if check_subscribe(call.from_user.id):
+    # ✅ "Tekshirish" bosilganda keshni chetlab o'tamiz
+    if check_subscribe(call.from_user.id, use_cache=False):
         bot.edit_message_text("✅ Obuna tasdiqlandi! Endi musiqa yuklash mumkin",
                               call.message.chat.id, call.message.message_id)
     else:
@@ -489,41 +2668,72 @@ def check_cb(call):
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("song_"))
 def song_callback(call):
+    wait = rate_limit_wait(call.from_user.id, "audio")
+    if wait:
+        bot.answer_callback_query(call.id, f"⏳ Juda tez! {wait} sekunddan keyin qayta bosing.")
+        return
+
     if not check_subscribe(call.from_user.id):
         bot.answer_callback_query(call.id, "❌ Avval kanalga obuna bo'ling!", show_alert=True)
         return
 
-    loading = bot.send_message(call.message.chat.id, "⏳ Qo'shiq yuklanmoqda...")
     update_daily_stats(call.from_user.id, is_request=True)
 
     try:
-        index = int(call.data.split("_")[1])
-        songs = user_search_cache.get(call.from_user.id)
-        if not songs or index >= len(songs):
-            raise Exception("Qo'shiq topilmadi")
-
-        song = songs[index]
-        mp3_path, url, title = download_mp3_from_url(song["url"], song["title"])
-
-        with open(mp3_path, "rb") as audio:
-            bot.send_audio(call.message.chat.id, audio, title=title)
+        payload = call.data.split("_", 1)[1]
+        if len(payload) == 11:
+            # ✅ song_<video_id>: restartdan keyin ham ishlaydi
+            song = find_user_song(call.from_user.id, payload) or {"url": youtube_url(payload), "title": None}
+        else:
+            # eski tugmalar: song_<index>
+            index = int(payload)
+            songs = user_search_cache.get(call.from_user.id)
+            if not songs or index >= len(songs):
+                raise Exception("Qo'shiq topilmadi")
+            song = songs[index]
+
+        # ✅ davomiylik qidiruvdan ma'lum -> navbatga qo'ymasdan rad etamiz
+        duration = int(song.get("duration") or 0)
+        if duration > MAX_AUDIO_DURATION:
+            stat_inc(FORMAT_STATS, "refused")
+            bot.answer_callback_query(call.id, too_large_text(duration), show_alert=True)
+            return
 
-        save_music(call.from_user.id, title, url)
+        enqueue_download(call.message.chat.id, call.from_user.id, song_job, song)
 
     except Exception as e:
+        record_error(e)
         bot.send_message(call.message.chat.id, f"❌ Xatolik: {e}")
         print("FULL TRACE:\n", traceback.format_exc())
-    finally:
-        try:
-            bot.delete_message(call.message.chat.id, loading.message_id)
-        except:
-            pass
-        clear_downloads()
+
+# @bot qo'shiq nomi -> lokal indeksdagi file_id'lar (YouTube/yuklashsiz). BotFather'da inline yoqilgan bo'lishi kerak
+INLINE_LIMIT = int(os.getenv("INLINE_LIMIT", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+
+@bot.inline_handler(func=lambda q: True)
+def inline_query(q):
+    with timed("inline"):
+        songs = local_search(q.query, limit=INLINE_LIMIT, fresh_days=0, with_file=True)
+    stat_inc(LOCAL_SEARCH_STATS, "inline")
+    results = [types.InlineQueryResultCachedAudio(id=song["id"], audio_file_id=song["file_id"]) for song in songs]
+    try:
+        bot.answer_inline_query(q.id, results, cache_time=INLINE_CACHE_TIME)
+    except Exception as e:
+        print("⚠️ Inline javob xato:", e)
+
+# Kanal a'zoligi o'zgarsa keshni darhol yangilaymiz (SUB_TRACK_UPDATES=1, bot kanal admini bo'lishi kerak)
+@bot.chat_member_handler()
+def chat_member_update(update):
+    username = getattr(update.chat, "username", None)
+    ch = f"@{username}" if username else None
+    if ch in CHANNELS:
+        set_member_status(ch, update.new_chat_member.user.id, update.new_chat_member.status)
 
 # ================== COMMANDS ==================
 @bot.message_handler(commands=["start"])
 def start(m):
-    save_user(m.from_user)
+    subscribed = check_subscribe(m.from_user.id)
+    save_user(m.from_user, subscribed)
     update_daily_stats(m.from_user.id)
 
     text = """👋 Assalomu alaykum!
@@ -532,7 +2742,7 @@ def start(m):
 🎤 Qo'shiqchi nomi yozsangiz - 10 ta qo'shiq
 📱 Instagram/YouTube link yuboring"""
 
-    if not check_subscribe(m.from_user.id):
+    if not subscribed:
         bot.send_message(m.chat.id, text + "\n\n📢 Avval kanalga obuna bo'ling:", reply_markup=subscribe_markup())
     else:
         bot.send_message(m.chat.id, text)
@@ -543,12 +2753,27 @@ def stats(m):
         return bot.send_message(m.chat.id, "⛔ Siz admin emassiz")
 
     today_users, month_users, today_requests, month_requests = get_monthly_stats()
-    conn, c = get_db()
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM music_requests")
-    total_requests_db = c.fetchone()[0]
-    conn.close()
+    total_users = stats_agg.rollup["total_users"]
+    total_requests_db = stats_agg.rollup["total_requests"]
+    cached_files = db_fetchone("SELECT COUNT(*) FROM file_cache")[0]
+
+    fc = dict(FILE_CACHE_STATS)
+    lookups = fc["hits"] + fc["misses"]
+    hit_rate = f"{fc['hits'] * 100 // lookups}%" if lookups else "—"
+    dq = download_scheduler.snapshot()
+    sf = dict(SINGLEFLIGHT_STATS)
+    ac = dict(AUDIO_CACHE_STATS)
+    ac_files, ac_size = audio_cache_usage()
+    tc = dict(TRANSCODE_STATS)
+    sub_lookups = sub_cache.hits + sub_cache.misses
+    sub_rate = f"{sub_cache.hits * 100 // sub_lookups}%" if sub_lookups else "—"
+    proxy_lines = "\n".join(
+        f"{'🔴' if p['open'] else '🟢'} {p['name']}: {p['ok']}/{p['ok'] + p['failed']} OK, "
+        f"{p['latency_ms'] if p['latency_ms'] is not None else '—'} ms"
+        for p in (proxy_pool.snapshot() if proxy_pool else [])
+    ) or "—"
+    sc_lookups = search_cache.hits + search_cache.misses
+    sc_rate = f"{search_cache.hits * 100 // sc_lookups}%" if sc_lookups else "—"
 
     bot.send_message(m.chat.id, f"""📊 STATISTIKA
 
@@ -561,42 +2786,114 @@ def stats(m):
 
 📈 OYDA (30 kun):
 👥 Foydalanuvchilar: {month_users:,}
-🎵 So'rovlar: {month_requests:,}""")
+🎵 So'rovlar: {month_requests:,}
+
+💾 FILE_ID KESH:
+📦 Fayllar: {cached_files}
+🎯 Hit/Miss: {fc['hits']}/{fc['misses']} ({hit_rate})
+♻️ Yaroqsiz: {fc['invalid']}
+
+⚙️ YUKLASH NAVBATI:
+🔄 Ishlayapti: {dq['running']}/{dq['workers']}
+⏳ Navbatda: {dq['pending']}
+🔮 Prefetch: {dq['low_running']} ishlayapti, {dq['low_pending']} navbatda, {PREFETCH_STATS['done']} tayyor, {PREFETCH_STATS['cancelled']} bekor
+🔗 Birlashtirilgan yuklashlar: {sf['shared']} (tejaldi) / {sf['leaders']}
+
+🗄 DISK KESH:
+📦 {ac_files} fayl, {ac_size / 1024 / 1024:.1f} / {AUDIO_CACHE_MAX_BYTES / 1024 / 1024:.0f} MB
+🎯 Hit/Miss: {ac['hits']}/{ac['misses']}
+🧹 O'chirildi: {ac['evicted_files']} fayl, {ac['evicted_bytes'] / 1024 / 1024:.1f} MB
+
+🎛 AUDIO ({AUDIO_DELIVERY_MODE}):
+➡️ O'zicha: {tc['passthrough']} | 📦 Remux: {tc['remuxed']} | 🔁 Encode: {tc['transcoded']}
+🧮 FFmpeg CPU: {tc['ffmpeg_cpu']:.1f}s | ~{cpu_saved_estimate():.1f}s tejaldi
+📏 Limit {MAX_UPLOAD_BYTES // 1024 // 1024} MB: ⛔ {FORMAT_STATS['refused']} rad | ⬇️ {FORMAT_STATS['downgraded']} past bitrate
+
+🔎 QIDIRUV KESH:
+📦 {len(search_cache)} so'rov | 🎯 {search_cache.hits}/{search_cache.misses} ({sc_rate})
+🗂 Lokal ({LOCAL_SEARCH}{'' if FTS_ENABLED else ', FTS5 yo‘q'}): {db_fetchone("SELECT COUNT(*) FROM tracks")[0]} trek | ⚡ {LOCAL_SEARCH_STATS['local']} lokal, 🔀 {LOCAL_SEARCH_STATS['merged']} aralash, 🌐 {LOCAL_SEARCH_STATS['remote']} YouTube, 🔍 {LOCAL_SEARCH_STATS['inline']} inline
+
+📢 OBUNA KESH:
+🎯 {sub_cache.hits}/{sub_cache.misses} ({sub_rate})
+
+🚦 LIMIT ({USER_RATE}/s, burst {USER_BURST:g}):
+⛔ Rad etildi: {sum(RATE_LIMIT_STATS.values())} | 👥 {len(user_buckets)} user
+
+🌐 PROXY:
+{proxy_lines}""")
+
+@bot.message_handler(commands=["broadcast"])
+def broadcast_cmd(m):
+    if not is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Siz admin emassiz")
+
+    parts = (m.text or "").split(maxsplit=1)
+    reply = m.reply_to_message
+    if not reply and len(parts) < 2:
+        return bot.send_message(m.chat.id, "📣 Xabarga reply qilib /broadcast yozing yoki: /broadcast <matn>")
+
+    if active_broadcast:
+        return bot.send_message(m.chat.id, f"⏳ Broadcast #{active_broadcast.id} hali tugamagan (/broadcast_stop)")
+
+    if reply:
+        row = create_broadcast(m.chat.id, from_chat_id=m.chat.id, message_id=reply.message_id)
+    else:
+        row = create_broadcast(m.chat.id, text=parts[1])
+    if not start_broadcast(row):
+        db_write("UPDATE broadcasts SET status = 'stopped' WHERE id = ?", (row[0],))
+        return bot.send_message(m.chat.id, "⏳ Boshqa broadcast hali tugamagan")
+    bot.send_message(m.chat.id, f"📣 Broadcast #{row[0]} boshlandi: {row[6]} ta user")
+
+@bot.message_handler(commands=["broadcast_stop"])
+def broadcast_stop_cmd(m):
+    if not is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Siz admin emassiz")
+    b = active_broadcast
+    if not b:
+        return bot.send_message(m.chat.id, "ℹ️ Faol broadcast yo'q")
+    b.stop.set()
+    bot.send_message(m.chat.id, f"⏹ Broadcast #{b.id} to'xtatilmoqda...")
 
 # ================== MAIN HANDLER ==================
 @bot.message_handler(func=lambda m: m.text and not m.text.startswith("/"))
 def handle(m):
-    save_user(m.from_user)
+    # ✅ limit save_user/obuna tekshiruvi/yt-dlp'dan oldin
+    wait = rate_limit_wait(m.from_user.id, request_kind(m.text))
+    if wait:
+        if notify_rate_limited(m.from_user.id):
+            bot.send_message(m.chat.id, f"⏳ Juda ko'p so'rov. {wait} sekunddan keyin qayta urinib ko'ring.")
+        return
+
+    subscribed = check_subscribe(m.from_user.id)
+    save_user(m.from_user, subscribed)
     update_daily_stats(m.from_user.id, is_request=True)
 
-    if not check_subscribe(m.from_user.id):
+    if not subscribed:
         bot.send_message(m.chat.id, "❗ Avval kanalga obuna bo'ling", reply_markup=subscribe_markup())
         return
 
     text_in = (m.text or "").strip()
     lower = text_in.lower()
 
+    # yangi so'rov -> oldingi qidiruvning prefetch'lari kerak emas
+    cancel_prefetch(m.from_user.id)
+
     loading = bot.send_message(m.chat.id, "🔍 Qidirilmoqda...")
 
     try:
         if "instagram.com" in lower:
-            video_path = download_instagram(text_in)
-
-            with open(video_path, "rb") as video:
-                bot.send_video(m.chat.id, video, caption="🎥 Video + Original Musiqa")
-
-            if not shutil.which("ffmpeg"):
-                bot.send_message(m.chat.id, "❌ FFmpeg topilmadi.")
-                return
+            enqueue_download(m.chat.id, m.from_user.id, instagram_job, text_in, timeout=INSTAGRAM_DEADLINE)
+            return
 
-            audio_path = extract_audio(video_path)
-            with open(audio_path, "rb") as audio:
-                bot.send_audio(m.chat.id, audio, title="🔊 Ovoz (Musiqasiz)")
+        # ✅ YouTube link: qidiruvsiz to'g'ridan-to'g'ri yuklashga
+        video_id = yt_video_id(text_in)
+        if video_id:
+            enqueue_download(m.chat.id, m.from_user.id, song_job, {"url": youtube_url(video_id), "title": None})
             return
 
-        results = search_artist_top10(text_in)
+        results = search_artist_top10(text_in, Deadline(SEARCH_DEADLINE))
         if results:
-            user_search_cache[m.from_user.id] = results
+            user_search_cache.set(m.from_user.id, results)
             text = f"🎤 <b>{text_in.upper()}</b> - Top 10:\n\n"
             kb = types.InlineKeyboardMarkup(row_width=2)
 
@@ -605,63 +2902,191 @@ def handle(m):
                 dur = int(song.get("duration") or 0)
                 duration = f" ({dur//60}:{dur%60:02d})" if dur else ""
                 btn_text = f"{song['number']}. {song['title'][:35]}{duration}"[:50]
-                buttons.append(types.InlineKeyboardButton(btn_text, callback_data=f"song_{song['number'] - 1}"))
+                buttons.append(types.InlineKeyboardButton(btn_text, callback_data=f"song_{song['id']}"))
 
             kb.add(*buttons)
             bot.send_message(m.chat.id, text, reply_markup=kb, parse_mode="HTML")
+            schedule_prefetch(m.from_user.id, results)
             return
 
-        with yt_dlp.YoutubeDL({**YTDLP_BASE_OPTS, "extract_flat": True}) as ydl:
-            info = ydl.extract_info(f"ytsearch1:{text_in}", download=False)
-            entry = (info.get("entries") or [None])[0]
-            if not entry:
-                raise Exception("Natija topilmadi")
-            yt_url = f"https://www.youtube.com/watch?v={entry.get('id')}"
-
-        mp3_path, url, title = download_mp3_from_url(yt_url, text_in)
-        with open(mp3_path, "rb") as audio:
-            bot.send_audio(m.chat.id, audio, title=title)
-        save_music(m.chat.id, title, url)
+        enqueue_download(m.chat.id, m.from_user.id, search_one_job, text_in)
 
     except Exception as e:
+        record_error(e)
         bot.send_message(m.chat.id, f"❌ Xatolik: {e}")
         print("FULL TRACE:\n", traceback.format_exc())
     finally:
-        clear_downloads()
         try:
             bot.delete_message(m.chat.id, loading.message_id)
         except:
             pass
 
-# ================== HEALTH SERVER (RENDER) ==================
+# ================== HEALTH + WEBHOOK SERVER (RENDER) ==================
+# secret barcha replikalarda bir xil bo'lishi kerak -> berilmasa tokendan hosil qilinadi
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_PATH = "/webhook/" + hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()[:16]
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+def render_metrics():
+    # ✅ Prometheus text format (0.0.4): mavjud *_STATS lug'atlaridan yig'iladi
+    lines = stage_latency.render("stage")
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+    q = download_scheduler.snapshot()
+    metric("musicbot_jobs_in_flight", "gauge", "Ishlayotgan yuklash ishlari", [
+        ({"lane": "user"}, q["running"]), ({"lane": "prefetch"}, q["low_running"]),
+    ])
+    metric("musicbot_queue_depth", "gauge", "Navbatdagi ishlar", [
+        ({"lane": "user"}, q["pending"]), ({"lane": "prefetch"}, q["low_pending"]),
+    ])
+    metric("musicbot_singleflight_in_flight", "gauge", "Birlashtirilgan yuklashlar", [
+        ({"kind": "audio"}, audio_flights.in_flight()), ({"kind": "file"}, file_flights.in_flight()),
+    ])
+
+    caches = (
+        ("file_id", FILE_CACHE_STATS["hits"], FILE_CACHE_STATS["misses"]),
+        ("audio_disk", AUDIO_CACHE_STATS["hits"], AUDIO_CACHE_STATS["misses"]),
+        ("search", search_cache.hits, search_cache.misses),
+        ("subscription", sub_cache.hits, sub_cache.misses),
+    )
+    metric("musicbot_cache_hits_total", "counter", "Kesh topildi", [({"cache": n}, h) for n, h, _ in caches])
+    metric("musicbot_cache_misses_total", "counter", "Kesh topilmadi", [({"cache": n}, m) for n, _, m in caches])
+    metric("musicbot_cache_hit_ratio", "gauge", "Kesh hit ulushi", [
+        ({"cache": n}, round(h / (h + m), 4) if h + m else 0) for n, h, m in caches
+    ])
+
+    metric("musicbot_ffmpeg_cpu_seconds_total", "counter", "ffmpeg CPU vaqti", [({}, round(TRANSCODE_STATS["ffmpeg_cpu"], 3))])
+    metric("musicbot_downloaded_bytes_total", "counter", "Yuklab olingan baytlar", [({}, DOWNLOAD_STATS["bytes"])])
+    metric("musicbot_downloads_total", "counter", "Yuklash yo'li bo'yicha", [
+        ({"path": k}, DOWNLOAD_STATS[k]) for k in ("ranged", "serial", "streamed")
+    ])
+    metric("musicbot_uploaded_bytes_total", "counter", "Telegramga yuborilgan baytlar", [({}, UPLOAD_STATS.get("bytes", 0))])
+    with stats_lock:
+        errors = sorted(ERROR_STATS.items())
+    with stats_lock:
+        limited = sorted(RATE_LIMIT_STATS.items())
+    metric("musicbot_search_source_total", "counter", "Qidiruv manbasi", [
+        ({"source": k}, v) for k, v in sorted(LOCAL_SEARCH_STATS.items())
+    ])
+    metric("musicbot_upload_limit_total", "counter", "Upload limiti: rad etilgan / past bitrate", [
+        ({"result": k}, v) for k, v in sorted(FORMAT_STATS.items())
+    ])
+    metric("musicbot_rate_limited_total", "counter", "Limit sabab rad etilgan so'rovlar", [({"kind": k}, n) for k, n in limited])
+    metric("musicbot_errors_total", "counter", "Xatolar turi bo'yicha", [({"type": t}, n) for t, n in errors])
+    return "\n".join(lines) + "\n"
+
 class Handler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         return
 
+    def do_POST(self):
+        if not WEBHOOK_URL or self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+            # ✅ threaded bot: handlerlar o'z thread pool'ida, javob darhol qaytadi
+            bot.process_new_updates([update])
+        except Exception as e:
+            print("❌ Webhook update xato:", e)
+
+        self.send_response(200)
+        self.end_headers()
+
     def do_GET(self):
         if self.path in ("/", "/health"):
             self.send_response(200)
             self.send_header("Content-type", "text/plain; charset=utf-8")
             self.end_headers()
             self.wfile.write(b"ok")
+        elif self.path == "/metrics":
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.end_headers()
 
 def run_server():
     port = int(os.environ.get("PORT", 10000))
-    HTTPServer(("0.0.0.0", port), Handler).serve_forever()
+    ThreadingHTTPServer(("0.0.0.0", port), Handler).serve_forever()
 
 threading.Thread(target=run_server, daemon=True).start()
+startup_mark("http server")
+
+def run_webhook():
+    allowed_updates = util.update_types if SUB_TRACK_UPDATES else None
+    bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+        max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+    )
+    print("✅ Webhook o'rnatildi:", WEBHOOK_URL + "/webhook/…")
+    startup_mark("set_webhook")
+    startup_report()
+    # updatelar HTTP server thread'larida keladi
+    threading.Event().wait()
+
+# ================== STARTUP (LAZY) ==================
+# FAST_STARTUP=1: og'ir ishlar polling boshlangandan keyin fonda; 0: avval hammasi tayyorlanadi
+FAST_STARTUP = os.getenv("FAST_STARTUP", "1").strip() != "0"
+
+def warm_up():
+    try:
+        setup_cookies()
+        if not ytdl_pools:
+            # workerlar yo'q -> yt_dlp shu processda ishlaydi
+            import yt_dlp
+        audio_cache_evict()
+        backfill_tracks()
+    except Exception as e:
+        print("⚠️ Warm-up xato:", e)
+
+def start_background():
+    if FAST_STARTUP:
+        threading.Thread(target=warm_up, daemon=True, name="warm-up").start()
+    else:
+        warm_up()
+        startup_mark("warm-up")
+    threading.Thread(target=auto_update_stats, daemon=True, name="description").start()
+    threading.Thread(target=auto_resume_broadcasts, daemon=True, name="broadcast-resume").start()
 
 if __name__ == "__main__":
-    update_bot_description()
+    start_background()
     print("🚀 Bot ishga tushdi - Stats FAOL!")
 
-    # webhookni “hard reset” (409 uchun ham foydali)
-    bot.remove_webhook()
-    time.sleep(2)
+    if WEBHOOK_URL:
+        run_webhook()
+
+    # webhookni o'chiramiz (bir marta yetadi; 409'ni lock hal qiladi)
     bot.remove_webhook()
-    time.sleep(2)
+    startup_mark("remove_webhook")
+    startup_report()
 
-    bot.infinity_polling(skip_pending=True, none_stop=True, timeout=60, long_polling_timeout=60)
\ No newline at end of file
+    allowed_updates = util.update_types if SUB_TRACK_UPDATES else None
+    bot.infinity_polling(skip_pending=True, none_stop=True, timeout=60, long_polling_timeout=60,
+                         allowed_updates=allowed_updates)
\ No newline at end of file
@@ -0,0 +1,118 @@
+# ================== YT-DLP WORKER ==================
+# yt-dlp worker processlarda ishlaydigan kod. server.py'ni import qilmaydi:
+# opts (cookies, proxy) parent'da tayyorlanadi, worker parent lock'lariga tegmaydi
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+PROXY_ENV_KEYS = [
+    "HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY",
+    "http_proxy", "https_proxy", "all_proxy",
+]
+
+@contextmanager
+def temp_unset_env(keys):
+    saved = {}
+    for k in keys:
+        if k in os.environ:
+            saved[k] = os.environ[k]
+            os.environ.pop(k, None)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            os.environ[k] = v
+
+class YtdlpError(Exception):
+    pass
+
+class _DeadlineAlarm(BaseException):
+    # BaseException: yt-dlp ichidagi `except Exception` ushlab, retry qilib yubormaydi
+    pass
+
+# YTDLP_PROCESSES=0 bo'lsa bot threadlarida ishlaydi -> holat thread bo'yicha
+_local = threading.local()
+
+def _deadline_hook(d):
+    # ✅ muddat tugasa yuklashni shu yerning o'zida to'xtatamiz
+    deadline_at = getattr(_local, "deadline_at", None)
+    if deadline_at and time.time() >= deadline_at:
+        raise YtdlpError("deadline")
+
+def _warm_ydl(profile, opts, proxy):
+    instances = getattr(_local, "instances", None)
+    if instances is None:
+        instances = _local.instances = {}
+
+    key = (profile, proxy)
+    ydl = instances.get(key)
+    if ydl is None:
+        # ✅ yt_dlp og'ir modul: birinchi kerak bo'lganda import qilinadi
+        import yt_dlp
+        opts = {**opts, "progress_hooks": [_deadline_hook]}
+        if proxy is not None:
+            opts["proxy"] = proxy
+        ydl = instances[key] = yt_dlp.YoutubeDL(opts)
+    return ydl
+
+def _on_alarm(signum, frame):
+    raise _DeadlineAlarm()
+
+def downloaded_path(ydl, info):
+    # ✅ aniq fayl yo'li yt-dlp'ning o'zidan (postprocessordan keyin ham)
+    downloads = info.get("requested_downloads") or []
+    if downloads and downloads[-1].get("filepath"):
+        return downloads[-1]["filepath"]
+    return info.get("filepath") or ydl.prepare_filename(info)
+
+def run(profile, opts, op, target, outtmpl=None, proxy=None, deadline_at=None):
+    # natija pickle qilinadigan (info, path)
+    # ✅ IG so‘rov paytida ENV proxy'larni vaqtincha o‘chirib turamiz
+    env_ctx = temp_unset_env(PROXY_ENV_KEYS) if profile == "instagram" else nullcontext()
+    _local.deadline_at = deadline_at
+    # ✅ worker processda muddat SIGALRM bilan majburlanadi: extract (progress hook yo'q) ham to'xtaydi
+    alarm = bool(deadline_at) and threading.current_thread() is threading.main_thread()
+    if alarm:
+        remaining = deadline_at - time.time()
+        if remaining <= 0:
+            raise YtdlpError("deadline")
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        with env_ctx:
+            ydl = _warm_ydl(profile, opts, proxy)
+            if outtmpl:
+                ydl.params["outtmpl"]["default"] = outtmpl
+
+            if op == "extract":
+                return ydl.sanitize_info(ydl.extract_info(target, download=False)), None
+            if op == "download":
+                info = ydl.extract_info(target, download=True)
+            else:
+                info = ydl.process_ie_result(target, download=True)
+            return ydl.sanitize_info(info), downloaded_path(ydl, info)
+
+    except _DeadlineAlarm:
+        getattr(_local, "instances", {}).pop((profile, proxy), None)
+        raise YtdlpError("deadline") from None
+    except Exception as e:
+        # buzilgan holatdagi instance'ni qayta ishlatmaymiz
+        getattr(_local, "instances", {}).pop((profile, proxy), None)
+        # yt-dlp exceptionlari har doim ham pickle bo'lmaydi
+        raise YtdlpError(str(e)) from None
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # parent'ning SIGTERM handleri (stats flush) qayta yaratilgan workerlarga o'tmasin
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _local.instances = {}
+    # ✅ har bir worker yt_dlp'ni o'zi import qiladi (fonda, birinchi so'rovdan oldin)
+    try:
+        import yt_dlp  # noqa: F401
+    except Exception:
+        pass